@@ -1,9 +1,9 @@
 """ Channel router to route messages to correct channel """
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.urls import path
 from chat.consumers import ChatConsumer
+from user.middleware import CachedAuthMiddlewareStack
 
 
 # Top level ASGI application stack - dispatch to other apps like websockets
@@ -11,7 +11,8 @@ application = ProtocolTypeRouter({
     # Using websocket protocol with security based on ALLOWED_HOSTS in settings
     'websocket': AllowedHostsOriginValidator(
         # Allow users connecting to websocket to be authenticated
-        AuthMiddlewareStack(
+        # Session and user come from cache - reconnects don't hit db
+        CachedAuthMiddlewareStack(
             # Declare views/paths handling websocket connections
             URLRouter([
                 path('ws/chat/<room_name>/', ChatConsumer.as_asgi()),
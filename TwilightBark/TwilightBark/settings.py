@@ -34,10 +34,10 @@ ALLOWED_HOSTS = []
 # Define User model in global scope
 AUTH_USER_MODEL = 'user.User'
 
-# Backend to allow case-insensitive email addresses
+# Backend to allow case-insensitive email addresses - only one so a failed
+# login is still a single lookup and a single password hash
 AUTHENTICATION_BACKENDS = (
-    'django.contrib.auth.backends.AllowAllUsersModelBackend',
-    'user.backends.CaseInsensitiveModelBackend'
+    'user.backends.CaseInsensitiveModelBackend',
 )
 
 # Application definition
@@ -88,23 +88,161 @@ WSGI_APPLICATION = 'TwilightBark.wsgi.application'
 ASGI_APPLICATION = 'TwilightBark.routing.application'
 # ASGI_APPLICATION = 'asgi.application'
 
+# 'chat.layers.HybridChannelLayer' hands group messages to sockets on the
+# same worker in memory and skips Redis for rooms with no members elsewhere
+# (opt-in - every worker must use it, since it sends workers notices)
+# capacity is how many messages can wait for one socket's consumer - past
+# that the layer drops group messages for it. It's the only per-socket
+# bound: daphne writes frames straight to the socket's buffer without
+# waiting, so ASGI send can't tell a client has stopped reading
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
             "hosts": [('localhost', 6379)],
+            "capacity": 100,
         },
     },
 }
 
+# Newest messages kept per room so joining a room doesn't query the db
+# Use 'chat.backlog.RedisBacklog' to share one backlog between daphne workers
+# LocalBacklog keeps at most max_rooms rooms, dropping least recently used
+CHAT_BACKLOG = {
+    'BACKEND': 'chat.backlog.LocalBacklog',
+    'CONFIG': {
+        'size': 50,
+        'max_rooms': 1000,
+    },
+}
+
+# Rooms looked up by name are cached per worker (LRU, TTL in seconds)
+CHAT_ROOM_CACHE = {
+    'SIZE': 1000,
+    'TTL': 300,
+}
+
+# Who is connected to each room - counts are per worker by default
+# Use 'chat.presence.RedisPresence' when running more than one daphne worker
+# SNAPSHOT also writes connected users to ChatRoom.users in db (slower)
+# Joins/leaves within DELTA_WINDOW seconds go out as one frame, listing
+# names only when there are at most DELTA_THRESHOLD of them
+CHAT_PRESENCE = {
+    'BACKEND': 'chat.presence.LocalPresence',
+    'SNAPSHOT': False,
+    'DELTA_WINDOW': 0.25,
+    'DELTA_THRESHOLD': 20,
+}
+
+# Room directory on landing page - rooms ranked by messages and joins, with
+# older activity counting half as much every half_life seconds
+# Use 'chat.directory.RedisDirectory' to share one ranking between workers
+# ROOMS is how many rooms are listed, TTL seconds the list is cached
+CHAT_DIRECTORY = {
+    'BACKEND': 'chat.directory.LocalDirectory',
+    'CONFIG': {
+        'half_life': 3600,
+        'size': 10000,
+    },
+    'ROOMS': 20,
+    'TTL': 10,
+}
+
+# Messages each user can send per second, plus a burst allowance on top -
+# ROOMS overrides both for named rooms
+# EX: 'ROOMS': {'announcements': {'RATE': 0.1, 'BURST': 1}}
+# History and search requests count against their own READS bucket
+CHAT_RATE_LIMIT = {
+    'RATE': 1.0,
+    'BURST': 5,
+    'ROOMS': {},
+    'READS': {
+        'RATE': 5.0,
+        'BURST': 20,
+    },
+}
+
+# How message times are sent - 'text' (EX: today at 1:01 PM, in TIME_ZONE)
+# or 'epoch' (milliseconds, formatted by browser in viewer's time zone)
+CHAT_TIMESTAMP_FORMAT = 'text'
+
+# Write-behind - broadcast messages right away and save them in batches
+# Messages still queued at shutdown are saved then; batches that keep
+# failing are passed to on_failure hook (dotted path) so they aren't lost
+# Broadcast frames have id null (row isn't saved yet), so clients page
+# history with the before cursor from history frames, never live frames
+CHAT_WRITE_BEHIND = {
+    'ENABLED': False,
+    'CONFIG': {
+        'batch_size': 100,
+        'flush_interval': 0.005,
+        'retries': 3,
+        'on_failure': 'chat.writer.log_failed_batch',
+    },
+}
+
+# Retention - archive_messages command moves messages older than DAYS (or
+# ROOMS[room name] days, None keeps room in db) into compressed files under
+# ROOT, SEGMENT_SIZE messages per file. History past db reads those files
+# COMPRESSION 'zstd' needs zstandard package installed (else gzip)
+CHAT_RETENTION = {
+    'DAYS': None,
+    'ROOMS': {},
+    'ROOT': os.path.join(BASE_DIR, 'archive'),
+    'SEGMENT_SIZE': 10000,
+    'COMPRESSION': 'gzip',
+}
+
+# Cache for sessions, chat user cards and websocket user lookups
+# LocMemCache is per process - fine for one daphne worker, but point every
+# worker at one shared cache (EX: memcached) before running more than one
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'twilightbark',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+# Sessions are read from cache and written through to db
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# SQLite by default - set POSTGRES_DB (plus POSTGRES_USER, POSTGRES_PASSWORD,
+# POSTGRES_HOST and POSTGRES_PORT as needed) to run on PostgreSQL instead
+# CONN_MAX_AGE keeps each db thread's connection open for that many seconds
+USE_POSTGRES = bool(os.environ.get('POSTGRES_DB'))
+
+if USE_POSTGRES:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ['POSTGRES_DB'],
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', 600)),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        }
     }
+
+# Threads websocket consumers run db queries on - each thread keeps its own
+# connection, so SIZE is most connections one daphne worker opens (keep
+# workers * SIZE under Postgres max_connections)
+# None runs every query on one shared thread - SQLite has one writer anyway
+CHAT_DB_POOL = {
+    'SIZE': int(os.environ.get('DB_POOL_SIZE', 10)) if USE_POSTGRES else None,
 }
 
 
@@ -157,3 +295,11 @@ STATIC_URL = '/static/'
 # Tell Django media file location directory
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/profile_images/'
+
+# Threads resizing uploaded profile pics into small chat avatars
+AVATAR_WORKERS = 2
+
+# Seconds username/avatar shown in chat is cached (dropped on account edit)
+USER_CARD_TIMEOUT = 3600
+# Seconds websocket handshakes reuse a cached user (dropped on any change)
+USER_CACHE_TIMEOUT = 300
@@ -1,15 +1,24 @@
 """ Define admin panel view for chat room system """
+import hashlib
+from datetime import datetime
 from django.contrib import admin
 from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
 from django.core.paginator import Paginator
+from django.db import connection
+from django.utils import timezone
+from django.utils.functional import cached_property
+from user.models import User
 from .models import ChatRoom, ChatMessage
+from .search import filter_matching
 
 
 class ChatRoomAdmin(admin.ModelAdmin):
     """ Define admin panel section for chat rooms """
-    list_display = ['id', 'name']
+    list_display = ['id', 'name', 'message_count', 'last_message_at']
     search_fields = ['name']
-    readonly_fields = ['id']
+    readonly_fields = ['id', 'message_count', 'last_message_id',
+                       'last_message_at']
 
     class Meta:
         model = ChatRoom
@@ -18,38 +27,167 @@ class ChatRoomAdmin(admin.ModelAdmin):
 admin.site.register(ChatRoom, ChatRoomAdmin)
 
 
+# Seconds admin keeps changelist counts and filter choices
+ADMIN_COUNT_TIMEOUT = 3600
+ADMIN_FACET_TIMEOUT = 600
+# Filtered changelists stop counting here - more just means more pages
+ADMIN_COUNT_LIMIT = 100000
+# Busiest rooms offered in room filter (others are reached through search)
+ADMIN_ROOM_CHOICES = 50
+# Users/rooms whose name matches a search that are looked for in messages
+# (a search matching more than this is too broad to page through anyway)
+ADMIN_SEARCH_NAMES = 500
+
+
+def estimated_rows(model):
+    """ Cheap row count for whole table (exact count scans every row) """
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # Planner statistics - updated by autovacuum/ANALYZE
+            cursor.execute("SELECT reltuples::bigint FROM pg_class "
+                           "WHERE relname = %s", [table])
+            row = cursor.fetchone()
+            if row and row[0] > 0:
+                return row[0]
+        elif connection.vendor == 'sqlite':
+            # Min/max of primary key are read from end of its index -
+            # ids deleted since only make estimate high
+            cursor.execute(f'SELECT MAX(id) - MIN(id) + 1 FROM "{table}"')
+            return cursor.fetchone()[0] or 0
+    return model._default_manager.count()
+
+
+def approximate_count(queryset):
+    """ Whole table is estimated, filtered results counted up to limit """
+    if not queryset.query.where:
+        return estimated_rows(queryset.model)
+    # COUNT over LIMITed subquery - stops reading rows at limit
+    return queryset.order_by()[:ADMIN_COUNT_LIMIT].count()
+
+
 class CachingPaginator(Paginator):
     """ Custom paginator to cache results so all don't show up in admin """
 
-    def _get_count(self):
-        """ Get count of objects """
-        if not hasattr(self, "_count"):
-            self._count = None
-        if self._count is None:
-            try:
-                # Set key to cache count
-                key = f"adm:{hash(self.object_list.query.__str__())}:count"
-                self._count = cache.get(key, -1)
-                if self._count == -1:
-                    self._count = super().count
-                    cache.set(key, self._count, 3600)
-            except Exception as e:
-                self._count = len(self.object_list)
-            return self._count
-
-    count = property(_get_count)
+    @cached_property
+    def count(self):
+        """ Approximate count, cached under key every worker agrees on """
+        try:
+            sql, params = self.object_list.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        # hash() is salted per process - sha1 of query is same everywhere
+        digest = hashlib.sha1(f'{sql}|{params!r}'.encode()).hexdigest()
+        key = f'adm:count:{digest}'
+        count = cache.get(key)
+        if count is None:
+            count = approximate_count(self.object_list)
+            cache.set(key, count, ADMIN_COUNT_TIMEOUT)
+        return count
+
+
+class RoomFilter(admin.SimpleListFilter):
+    """ Busiest rooms, from rooms' message counters """
+    title = 'room'
+    parameter_name = 'room'
+
+    def lookups(self, request, model_admin):
+        """ (room id, name with message count) for busiest rooms """
+        choices = cache.get('adm:facet:rooms')
+        if choices is None:
+            # Counters read from rooms table - no GROUP BY over messages
+            rooms = (ChatRoom.objects.order_by('-message_count')
+                     .values('id', 'name', 'message_count')
+                     [:ADMIN_ROOM_CHOICES])
+            choices = [(str(row['id']),
+                        f"{row['name']} ({row['message_count']})")
+                       for row in rooms]
+            cache.set('adm:facet:rooms', choices, ADMIN_FACET_TIMEOUT)
+        return choices
+
+    def queryset(self, request, queryset):
+        """ Messages in chosen room - uses (room, id) index """
+        if self.value():
+            return queryset.filter(room_id=self.value())
+        return queryset
+
+
+class MonthFilter(admin.SimpleListFilter):
+    """ Months between first and last message (no date_hierarchy scan) """
+    title = 'month'
+    parameter_name = 'month'
+
+    def lookups(self, request, model_admin):
+        """ ('YYYY-MM', 'Month YYYY') newest first from cached id range """
+        choices = cache.get('adm:facet:months')
+        if choices is None:
+            # First and last message found through primary key index
+            first = ChatMessage.objects.order_by('id').first()
+            last = ChatMessage.objects.order_by('-id').first()
+            choices = []
+            if first and last:
+                # Months as seen in site's time zone (TIME_ZONE)
+                newest = timezone.localtime(last.timestamp)
+                oldest = timezone.localtime(first.timestamp)
+                year, month = newest.year, newest.month
+                while (year, month) >= (oldest.year, oldest.month):
+                    label = datetime(year, month, 1).strftime('%B %Y')
+                    choices.append((f'{year}-{month:02d}', label))
+                    month -= 1
+                    if month == 0:
+                        year, month = year - 1, 12
+            cache.set('adm:facet:months', choices, ADMIN_FACET_TIMEOUT)
+        return choices
+
+    def queryset(self, request, queryset):
+        """ Messages sent during chosen month """
+        if not self.value():
+            return queryset
+        try:
+            year, month = map(int, self.value().split('-'))
+            start = timezone.make_aware(datetime(year, month, 1))
+        except ValueError:
+            return queryset.none()
+        end = timezone.make_aware(
+            datetime(year + month // 12, month % 12 + 1, 1))
+        return queryset.filter(timestamp__gte=start, timestamp__lt=end)
 
 
 class ChatMessageAdmin(admin.ModelAdmin):
     """ Define admin panel section for chat messages """
     list_display = ['room', 'user', 'timestamp']
-    list_filter = ['room', 'user', 'message', 'timestamp']
+    # No filters that list distinct values of big columns (message, user) -
+    # rooms and months come from cached aggregates, timestamp choices are
+    # fixed ranges (no date_hierarchy - it reads distinct dates)
+    list_filter = [RoomFilter, MonthFilter, 'timestamp']
+    # Shows search box - lookups themselves are in get_search_results
     search_fields = ['user__username', 'room__name']
     readonly_fields = ['id', 'user', 'room', 'timestamp']
+    # Newest first walks primary key index, rooms and users in same query
+    ordering = ['-id']
+    list_select_related = ['room', 'user']
 
     show_full_result_count = False
     paginator = CachingPaginator
 
+    def get_search_results(self, request, queryset, search_term):
+        """ Match message text through full-text index, names through ids """
+        if not search_term:
+            return queryset, False
+        # Narrowed from filtered queryset so room/month filters still apply
+        matches = filter_matching(queryset, search_term)
+        # Names are matched in small user and room tables first - LIKE on
+        # joined names ORed with text search would scan every message
+        user_ids = list(User.objects.filter(username__icontains=search_term)
+                        .values_list('id', flat=True)[:ADMIN_SEARCH_NAMES])
+        room_ids = list(ChatRoom.objects.filter(name__icontains=search_term)
+                        .values_list('id', flat=True)[:ADMIN_SEARCH_NAMES])
+        if user_ids:
+            matches |= queryset.filter(user_id__in=user_ids)
+        if room_ids:
+            matches |= queryset.filter(room_id__in=room_ids)
+        return matches, False
+
     class Meta:
         model = ChatMessage
 
@@ -0,0 +1,185 @@
+""" Old messages moved out of db into compressed per-room archive files """
+import gzip
+import json
+import os
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils.dateparse import parse_datetime
+from functools import lru_cache
+from .models import ChatMessage, ChatRoom
+from .utils import HISTORY_FIELDS
+
+try:
+    import zstandard
+except ImportError:
+    # Optional - archives are gzip without it
+    zstandard = None
+
+
+# File ending -> function opening segment as text
+OPENERS = {
+    '.gz': gzip.open,
+    '.zst': lambda path, mode: zstandard.open(path, mode),
+}
+
+
+def retention_config():
+    """ CHAT_RETENTION with defaults filled in """
+    config = getattr(settings, 'CHAT_RETENTION', {})
+    return {
+        'DAYS': config.get('DAYS'),
+        'ROOMS': config.get('ROOMS', {}),
+        'ROOT': config.get('ROOT', os.path.join(settings.BASE_DIR,
+                                                'archive')),
+        'SEGMENT_SIZE': config.get('SEGMENT_SIZE', 10000),
+        'COMPRESSION': config.get('COMPRESSION', 'gzip'),
+    }
+
+
+def retention_days(room_name):
+    """ Days room's messages stay in db (None keeps them forever) """
+    config = retention_config()
+    return config['ROOMS'].get(room_name, config['DAYS'])
+
+
+# Each rewrite of index adds new (path, mtime) key - bound so old ones go
+@lru_cache(maxsize=128)
+def load_index(path, modified):
+    """ Segment list from index file (cached until file changes) """
+    with open(path) as f:
+        return json.load(f)['segments']
+
+
+def read_segment(path):
+    """ Yield rows in segment oldest first, one line at a time """
+    with OPENERS[os.path.splitext(path)[1]](path, 'rt') as f:
+        for line in f:
+            row = json.loads(line)
+            row['timestamp'] = parse_datetime(row['timestamp'])
+            yield row
+
+
+@lru_cache(maxsize=8)
+def load_segment(path):
+    """ Rows in segment oldest first - segments never change once written """
+    return list(read_segment(path))
+
+
+class RoomArchive:
+    """ Append-only segments of one room's oldest messages plus index """
+
+    def __init__(self, room_id, root=None):
+        self.path = os.path.join(root or retention_config()['ROOT'],
+                                 str(room_id))
+        self.index_path = os.path.join(self.path, 'index.json')
+
+    def segments(self):
+        """ [{file, first_id, last_id, count, ...}] oldest segment first """
+        try:
+            modified = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        return load_index(self.index_path, modified)
+
+    def last_id(self):
+        """ Newest archived message id (0 if nothing archived) """
+        segments = self.segments()
+        return segments[-1]['last_id'] if segments else 0
+
+    def rows(self, since=None, until=None):
+        """ Yield every archived row oldest first (since <= time < until) """
+        for segment in self.segments():
+            # Index times let whole segments outside range be skipped
+            if since and parse_datetime(segment['last_at']) < since:
+                continue
+            if until and parse_datetime(segment['first_at']) >= until:
+                break
+            for row in read_segment(os.path.join(self.path,
+                                                 segment['file'])):
+                if ((since is None or row['timestamp'] >= since) and
+                        (until is None or row['timestamp'] < until)):
+                    yield row
+
+    def append(self, rows, compression='gzip'):
+        """ Write rows (oldest first, newer than last_id) as new segment """
+        os.makedirs(self.path, exist_ok=True)
+        ending = '.zst' if compression == 'zstd' and zstandard else '.gz'
+        name = f"{rows[0]['id']:012d}-{rows[-1]['id']:012d}.jsonl{ending}"
+        with OPENERS[ending](os.path.join(self.path, name + '.tmp'),
+                             'wt') as f:
+            for row in rows:
+                f.write(json.dumps(dict(
+                    row, timestamp=row['timestamp'].isoformat())) + '\n')
+        segments = self.segments() + [{
+            'file': name,
+            'first_id': rows[0]['id'],
+            'last_id': rows[-1]['id'],
+            'count': len(rows),
+            'first_at': rows[0]['timestamp'].isoformat(),
+            'last_at': rows[-1]['timestamp'].isoformat(),
+        }]
+        # Renamed into place so readers never see half written files
+        os.replace(os.path.join(self.path, name + '.tmp'),
+                   os.path.join(self.path, name))
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump({'segments': segments}, f, indent=1)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def page_before(self, before=None, count=5):
+        """ Archived rows older than message id before (latest first) """
+        messages = []
+        for segment in reversed(self.segments()):
+            if len(messages) >= count:
+                break
+            if before is not None and segment['first_id'] >= before:
+                continue
+            rows = load_segment(os.path.join(self.path, segment['file']))
+            for row in reversed(rows):
+                if before is None or row['id'] < before:
+                    messages.append(row)
+                    if len(messages) == count:
+                        break
+        oldest = messages[-1]['id'] if messages else before
+        # More left if oldest segment starts before last row returned
+        segments = self.segments()
+        has_more = bool(segments) and (oldest is None or
+                                       segments[0]['first_id'] < oldest)
+        return messages, has_more
+
+
+def archive_room(room, cutoff, segment_size, compression='gzip'):
+    """ Move room's messages older than cutoff into archive - return count """
+    archive = RoomArchive(room.id)
+    # Rows archived by a run that stopped before deleting them
+    moved = remove_messages(room, ChatMessage.objects.filter(
+        room=room, id__lte=archive.last_id()))
+    while True:
+        # Oldest messages by id - archive is always a prefix of room's ids
+        rows = list(ChatMessage.objects.by_room(room).reverse()
+                    .values(*HISTORY_FIELDS)[:segment_size])
+        expired = []
+        for row in rows:
+            if row['timestamp'] >= cutoff:
+                # Stop at first message still inside retention window
+                break
+            expired.append(row)
+        if not expired:
+            return moved
+        # Files first - messages only leave db once they are safe on disk
+        archive.append(expired, compression)
+        moved += remove_messages(room, ChatMessage.objects.filter(
+            room=room, id__lte=expired[-1]['id']))
+        if len(expired) < segment_size:
+            return moved
+
+
+def remove_messages(room, queryset):
+    """ Delete archived messages and take them off room's message count """
+    with transaction.atomic():
+        deleted = queryset.delete()[0]
+        if deleted:
+            ChatRoom.objects.filter(pk=room.pk).update(
+                message_count=Greatest(F('message_count') - deleted, 0))
+    return deleted
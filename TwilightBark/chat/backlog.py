@@ -0,0 +1,163 @@
+""" Per-room cache of recent messages so joining a room skips the db """
+import json
+from asgiref.sync import sync_to_async
+from collections import deque, OrderedDict
+from functools import lru_cache
+from itertools import islice
+from .utils import load_backend
+
+
+class LocalBacklog:
+    """ Bounded ring buffer of newest messages per room, kept in process """
+
+    def __init__(self, size=50, max_rooms=1000):
+        """ size is max number of messages kept for each room """
+        self.size = size
+        self.max_rooms = max_rooms
+        # room id -> buffer, least recently used first
+        self.rooms = OrderedDict()
+
+    def new_room(self):
+        """ Empty buffer - warm is False until room has been read from db """
+        return {"messages": deque(maxlen=self.size),
+                "older": False, "warm": False}
+
+    def keep(self, room_id, room):
+        """ Store room as most recently used - coldest room drops if full """
+        self.rooms[room_id] = room
+        self.rooms.move_to_end(room_id)
+        if len(self.rooms) > self.max_rooms:
+            # Dropped room is read from db again on its next join
+            self.rooms.popitem(last=False)
+
+    async def recent(self, room_id, count):
+        """ Return (messages latest first, has_more) or None if not cached """
+        room = self.rooms.get(room_id)
+        if room is None or not room["warm"]:
+            # Room has never been loaded from db so can't trust buffer
+            return None
+        self.rooms.move_to_end(room_id)
+        buffer = room["messages"]
+        messages = list(islice(reversed(buffer), count))
+        return messages, len(buffer) > count or room["older"]
+
+    async def fill(self, room_id, messages, has_more):
+        """ Warm room with messages read from db (latest first) """
+        room = self.rooms.get(room_id) or self.new_room()
+        if room["warm"]:
+            # Another connection already warmed this room
+            return
+        # Keep messages pushed while db was being read (not in db result)
+        newest = messages[0]["id"] if messages else 0
+        pushed = [message for message in room["messages"]
+                  if message["id"] > newest]
+        room["messages"].clear()
+        room["messages"].extend(reversed(messages))
+        room["messages"].extend(pushed)
+        # Older messages exist if db had more or some fell out of buffer
+        room["older"] = has_more or len(messages) + len(pushed) > self.size
+        room["warm"] = True
+        self.keep(room_id, room)
+
+    async def push(self, room_id, message):
+        """ Add newly saved message to room - oldest message drops off """
+        room = self.rooms.get(room_id) or self.new_room()
+        self.keep(room_id, room)
+        if len(room["messages"]) == self.size:
+            # Oldest cached message is about to drop but still exists in db
+            room["older"] = True
+        room["messages"].append(message)
+
+    async def clear(self, room_id):
+        """ Forget cached messages for room (next join reloads from db) """
+        self.rooms.pop(room_id, None)
+
+
+class RedisBacklog:
+    """ Recent messages per room in Redis, shared between daphne workers """
+
+    # Sorted set scored by message id rather than a list, so messages pushed
+    # while another worker is filling the room from db merge in id order
+    PUSH_SCRIPT = """
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+        local dropped = redis.call('ZREMRANGEBYRANK', KEYS[1], 0,
+                                   -tonumber(ARGV[3]) - 1)
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        if dropped > 0 and redis.call('EXISTS', KEYS[2]) == 1 then
+            redis.call('SET', KEYS[2], '1', 'EX', ARGV[4])
+        end
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, size=50,
+                 expiry=86400, prefix='backlog'):
+        """ expiry is seconds an idle room's backlog is kept in Redis """
+        import redis
+        self.redis = redis.Redis(host=host, port=port, db=db)
+        self.size = size
+        self.expiry = expiry
+        self.prefix = prefix
+        self.push_script = self.redis.register_script(self.PUSH_SCRIPT)
+
+    def keys(self, room_id):
+        """ Redis keys for room's messages and its warm/has-more marker """
+        key = f"{self.prefix}:{room_id}"
+        return key, f"{key}:older"
+
+    async def recent(self, room_id, count):
+        """ Return (messages latest first, has_more) or None if not cached """
+        return await sync_to_async(self._recent, thread_sensitive=False)(
+            room_id, count)
+
+    def _recent(self, room_id, count):
+        key, marker = self.keys(room_id)
+        pipe = self.redis.pipeline()
+        pipe.zrevrange(key, 0, count)
+        pipe.get(marker)
+        rows, older_in_db = pipe.execute()
+        if older_in_db is None:
+            # Room has never been loaded from db so can't trust sorted set
+            return None
+        messages = [json.loads(row) for row in rows]
+        has_more = len(messages) > count or older_in_db == b"1"
+        return messages[:count], has_more
+
+    async def fill(self, room_id, messages, has_more):
+        """ Warm room with messages read from db (latest first) """
+        await sync_to_async(self._fill, thread_sensitive=False)(
+            room_id, messages, has_more)
+
+    def _fill(self, room_id, messages, has_more):
+        key, marker = self.keys(room_id)
+        pipe = self.redis.pipeline()
+        # Same encoding as push so a message pushed meanwhile isn't doubled
+        if messages:
+            pipe.zadd(key, {json.dumps(message, sort_keys=True): message["id"]
+                            for message in messages})
+        pipe.zremrangebyrank(key, 0, -self.size - 1)
+        pipe.expire(key, self.expiry)
+        dropped = pipe.execute()[-2]
+        # Older messages exist if db had more or some fell out of the set
+        older_in_db = has_more or dropped > 0
+        self.redis.set(marker, "1" if older_in_db else "0", ex=self.expiry)
+
+    async def push(self, room_id, message):
+        """ Add newly saved message to room - oldest message drops off """
+        await sync_to_async(self._push, thread_sensitive=False)(
+            room_id, message)
+
+    def _push(self, room_id, message):
+        self.push_script(keys=self.keys(room_id),
+                         args=[message["id"],
+                               json.dumps(message, sort_keys=True),
+                               self.size, self.expiry])
+
+    async def clear(self, room_id):
+        """ Forget cached messages for room (next join reloads from db) """
+        await sync_to_async(self.redis.delete, thread_sensitive=False)(
+            *self.keys(room_id))
+
+
+@lru_cache(maxsize=None)
+def get_backlog():
+    """ Return process-wide backlog backend defined by CHAT_BACKLOG """
+    return load_backend('CHAT_BACKLOG', 'chat.backlog.LocalBacklog')
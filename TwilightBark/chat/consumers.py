@@ -1,17 +1,33 @@
 """ Set up server-side consumer to handle backend websocket connections """
-import json
-from channels.db import database_sync_to_async
+import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
-from datetime import datetime
-from django.core.paginator import Paginator
+from django.db import transaction
 from math import ceil
-from .models import ChatRoom, ChatMessage
-from .utils import calculate_time, PayloadSerializer
+from .archive import RoomArchive
+from .backlog import get_backlog
+from .db import database_sync_to_async
+from .directory import get_directory, JOIN_WEIGHT, MESSAGE_WEIGHT
+from .limits import get_limiter, get_read_limiter
+from .models import ChatMessage, ChatRoom, MESSAGES_PER_PAGE
+from .presence import get_aggregator, get_presence, snapshot_enabled
+from .protocol import (choose_protocol, decode_frame, encode_frame, msgpack,
+                       JSON_PROTOCOL, MSGPACK_PROTOCOL)
+from .rooms import get_registry
+from .search import search_room
+from .utils import (encode_history, load_user_card, serialize_message,
+                    with_display_time, HISTORY_FIELDS)
+from .writer import get_writer
+
+
+logger = logging.getLogger(__name__)
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
     """ Consumer to asynchronously handle server websocket events """
 
+    # Wire format agreed in handshake (None is plain JSON like old clients)
+    protocol = None
+
     # connect, disconnect, and receive are built-in functions
     async def connect(self):
         """ Add user to room group and send message to group """
@@ -20,18 +36,22 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = f"chat_{self.room_name}"
 
-        try:
-            # If room exists in db, get room object
-            room = await get_room(self.room_name)
-        except Exception as e:
-            # If room doesn't exist in db, create room object
-            room = await create_room(self.room_name)
+        # Get room object (created in db if new) - kept for life of socket
+        self.room = room = await get_registry().get_or_create(self.room_name)
 
-        # Find user making connection request and add to db ChatRoom user list
+        # Find user making connection request and add to room's presence
         user = self.scope["user"]
         is_auth = user.is_authenticated
+        presence = get_presence()
+        first_tab = False
         if is_auth:
-            await connect_user(room, user)
+            first_tab, total_users = await presence.join(room.id, user.id)
+            if first_tab:
+                # New user in room moves it up room directory
+                await get_directory().record(room.id, JOIN_WEIGHT)
+            if first_tab and snapshot_enabled():
+                # Optional copy of who's connected in db ChatRoom user list
+                await connect_user(room, user)
 
         # Add user to room group - group members receive messages from room
         await self.channel_layer.group_add(
@@ -39,35 +59,38 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        # Accept all connections (even if not authenticated)
-        await self.accept()
-
-        # Get backlog of existing messages from db
-        payload = await get_room_chat_messages(room)
-        if payload:
-            # Put into correct format for frontend
-            payload = json.loads(payload)
-            await self.send(text_data=json.dumps({
-                # Only send message to self, not group
-                "type": "load_messages",
-                # Reverse dict to get messages in correct order oops
-                # Messages contains data about messages, not just message text
-                "messages": payload["messages"][::-1],
-                "pageNum": payload["pageNum"]
-            }))
-        # Send message to room group - new user's name and new total user count
-        total_users = get_num_users(room)
-        await self.channel_layer.group_send(
-            # Send message to everyone in room group
-            self.room_group_name,
-            {
-                # Type means pass params to connect_disconnect() function
-                "type": "connect_disconnect",
-                "user": user.username,
-                "count": total_users,
-                "event": "join"
-            }
-        )
+        # Accept all connections (even if not authenticated) - frames are
+        # compact msgpack if client asked for it in its subprotocol list
+        self.protocol = choose_protocol(self.scope.get("subprotocols", []))
+        await self.accept(subprotocol=self.protocol)
+
+        # Get backlog of existing messages (from room's cache after first join)
+        payload = await get_room_history(room)
+        if payload is None:
+            # db read failed - join with empty log, next join tries db again
+            await self.send_frame({
+                "msg_type": "error",
+                "error": "Could not load messages - reload to try again"
+            })
+            payload = {"messages": [], "before": None, "hasMore": False}
+        # Counted in memory - connect makes no db queries once room is warm
+        page_num = get_page_count(get_registry().message_count(room))
+        await self.send_frame({
+            # Only send message to self, not group
+            "type": "load_messages",
+            # Reverse list to get messages in correct order oops
+            # Messages contains data about messages, not just message text
+            "messages": payload["messages"][::-1],
+            "pageNum": page_num,
+            # Cursor for next load_older request - oldest id sent so far
+            "before": payload["before"],
+            "hasMore": payload["hasMore"]
+        })
+        # Tell room group new user joined - batched with other joins/leaves
+        get_aggregator().add(
+            self.channel_layer, self.room_group_name, room.id,
+            # Extra tabs of same user only update count, no joined line
+            joined=user.username if first_tab else "")
 
     async def disconnect(self, close_code):
         """ Remove user from room group and send message to room group """
@@ -76,12 +99,19 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = "chat_%s" % self.room_name
 
-        # Find user making disconnect request - remove from db if authenticated
-        room = await get_room(self.room_name)
+        # Find user making disconnect request - remove from room's presence
+        room = getattr(self, "room", None)
+        if room is None:
+            # Socket closed before connect found room - nothing to undo
+            return
         user = self.scope["user"]
         is_auth = user.is_authenticated
+        presence = get_presence()
+        last_tab = False
         if is_auth:
-            await disconnect_user(room, user)
+            last_tab, total_users = await presence.leave(room.id, user.id)
+            if last_tab and snapshot_enabled():
+                await disconnect_user(room, user)
 
         # Remove user from room group
         await self.channel_layer.group_discard(
@@ -89,89 +119,185 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        total_users = get_num_users(room)
-        await self.channel_layer.group_send(
-            # Send message to all members of room group
-            self.room_group_name,
-            {
-                "type": "connect_disconnect",
-                "user": user.username,
-                "count": total_users,
-                "event": "leave"
-            }
-        )
+        # Tell rest of room group user left - batched like joins
+        get_aggregator().add(
+            self.channel_layer, self.room_group_name, room.id,
+            # User still has other tabs open - only update count
+            left=user.username if last_tab else "")
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """ Receive message from websocket frontend """
-        text_data_json = json.loads(text_data)
-        message = text_data_json["message"]
         user = self.scope["user"]
+        # Users share buckets across tabs, anonymous sockets get their own
+        sender = user.id if user.is_authenticated else self.channel_name
+        try:
+            text_data_json = decode_frame(text_data, bytes_data)
+        except ValueError:
+            # EX: binary frame when msgpack isn't installed - drop, not crash
+            await self.send_frame({
+                "msg_type": "error",
+                "error": "Could not read frame"
+            })
+            return
+        command = text_data_json.get("command")
+        if command in ("load_older", "search"):
+            # Reads have own bucket so scrolling back doesn't use up sends
+            if not get_read_limiter().allow(self.room_name, sender):
+                await self.send_frame({
+                    "msg_type": "error",
+                    "error": "Slow down - too many history requests"
+                })
+                return
+        if command == "load_older":
+            # Anyone who can see the backlog can scroll back through history
+            await self.load_older(text_data_json.get("before"))
+            return
+        if command == "search":
+            # Ranked full-text search over room's messages, page by page
+            await self.search(text_data_json.get("query"),
+                              text_data_json.get("page", 1))
+            return
+        message = text_data_json.get("message")
+        if command is not None or not isinstance(message, str):
+            # EX: misspelled command or no message - checked before limiter
+            # so a bad frame doesn't use up a send
+            await self.send_frame({
+                "msg_type": "error",
+                "error": ("Unknown command" if command is not None
+                          else "Invalid message")
+            })
+            return
+        if not get_limiter().allow(self.room_name, sender):
+            # Over limit - tell client and skip db write and broadcast
+            await self.send_frame({
+                "msg_type": "error",
+                "error": "Slow down - you are sending messages too fast"
+            })
+            return
 
         if user.is_authenticated:
             # Only users can send messages - save to db and send to room group
-            room = await get_room(self.room_name)
+            room = self.room
             if message:
-                # Save message to db
-                await create_message(room, user, message)
+                writer = get_writer()
+                if writer:
+                    # Write-behind - queued and saved in next batch, so frame
+                    # goes out with id None (clients page with before cursor)
+                    chat_message = writer.submit(room, user, message)
+                else:
+                    # Save message to db
+                    chat_message = await create_message(room, user, message)
+                await get_directory().record(room.id, MESSAGE_WEIGHT)
+                # Build frame once here - every recipient forwards same text
+                # so timestamp is identical for everyone
+                frame = {"msg_type": "message"}
+                card = await load_user_card(user.id)
+                frame.update(with_display_time(
+                    [serialize_message(chat_message, card)])[0])
                 # Send message to room group
                 await self.channel_layer.group_send(
                     # type defines handler function to call
                     self.room_group_name,
                     {
                         "type": "create_chat_message",
-                        # Message contains ONLY message text
-                        "message": message,
-                        "user": user.username,
-                        # Pic to be set immediately
-                        "pic": user.profile_pic.url,
+                        # Ready to send json (message text, user, time, pic)
+                        "text": encode_frame(frame, JSON_PROTOCOL)[0],
+                        # Same frame in compact form for msgpack clients
+                        "bytes": (encode_frame(frame, MSGPACK_PROTOCOL)[1]
+                                  if msgpack else None),
                     }
                 )
         else:
             # Anonymous users can't send messages
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 "msg_type": "error",
                 "error": "You are not logged in"
-            }))
+            })
 
     # Custom helper functions for connect, disconnect, and receive
 
+    async def load_older(self, before):
+        """ Send page of messages older than message id before to self """
+        try:
+            before = int(before)
+        except (TypeError, ValueError):
+            await self.send_frame({
+                "msg_type": "error",
+                "error": "Invalid history cursor"
+            })
+            return
+        payload = await get_room_history(self.room, before)
+        if payload is None:
+            # Client keeps its cursor so it can ask for same page again
+            await self.send_frame({
+                "msg_type": "error",
+                "error": "Could not load older messages - try again"
+            })
+            return
+        await self.send_frame({
+            "msg_type": "older_messages",
+            # Oldest first so frontend can prepend in order
+            "messages": payload["messages"][::-1],
+            "before": payload["before"],
+            "hasMore": payload["hasMore"]
+        })
+
+    async def search(self, query, page):
+        """ Send page of messages in room matching query to self """
+        try:
+            page = max(1, int(page))
+        except (TypeError, ValueError):
+            page = None
+        if not isinstance(query, str) or page is None:
+            await self.send_frame({
+                "msg_type": "error",
+                "error": "Invalid search"
+            })
+            return
+        messages, has_more = await search_room_messages(self.room, query,
+                                                        page)
+        await self.send_frame({
+            "msg_type": "search_results",
+            "query": query,
+            "page": page,
+            # Best match first
+            "messages": messages,
+            "hasMore": has_more
+        })
+
+    async def send_frame(self, frame):
+        """ Send frame to this socket in format agreed at handshake """
+        text_data, bytes_data = encode_frame(frame, self.protocol)
+        await self.send(text_data=text_data, bytes_data=bytes_data)
+
     # Receive message from room group
     async def create_chat_message(self, event):
-        message = event["message"]
-        timestamp = calculate_time(datetime.now())
-
-        await self.send(text_data=json.dumps({
-            # Send message and data to frontend
-            "msg_type": "message",
-            "message": message,
-            "user": event["user"],
-            "timestamp": timestamp,
-            "pic": event["pic"],
-        }))
+        # Frame was already encoded by sender - pass it straight through
+        if self.protocol == MSGPACK_PROTOCOL:
+            await self.send(bytes_data=event["bytes"])
+        else:
+            await self.send(text_data=event["text"])
 
     async def connected_user_count(self, event):
         # Send number of users to frontend
-        await self.send_json(
-            {
-                "msg_type": "count",
-                "count": event["count"]
-            },
-        )
-
-    async def connect_disconnect(self, event):
-        """ Send message to room group based on event passed in connect() """
-        join_leave = event["event"]
-        await self.send(text_data=json.dumps({
-            "msg_type": join_leave,
-            "user": event["user"],
+        await self.send_frame({
+            "msg_type": "count",
+            "count": event["count"]
+        })
+
+    async def presence_delta(self, event):
+        """ Send batch of joins/leaves and new user count to frontend """
+        frame = {
+            "msg_type": "presence",
             "count": event["count"],
-        }))
-
-
-@database_sync_to_async
-def create_room(name):
-    """ Create new ChatRoom object in db based on name """
-    return ChatRoom.objects.create(name=name)
+            "joinedCount": event["joinedCount"],
+            "leftCount": event["leftCount"],
+        }
+        if "joined" in event:
+            # Names only included when batch is under threshold
+            frame["joined"] = event["joined"]
+            frame["left"] = event["left"]
+        await self.send_frame(frame)
 
 
 @database_sync_to_async
@@ -186,48 +312,84 @@ def disconnect_user(room, user):
     return room.disconnect_user(user)
 
 
-@database_sync_to_async
-def get_room(room_name):
-    """ Return ChatRoom object from db based on name """
-    try:
-        room = ChatRoom.objects.get(name=room_name)
-    except ChatRoom.DoesNotExist:
-        raise Exception("Room does not exist")
-    return room
+async def create_message(room, user, message):
+    """ Save new ChatMessage to db and add it to room's recent backlog """
+    chat_message = await save_message(room, user, message)
+    get_registry().count_messages(room.id)
+    card = await load_user_card(user.id)
+    await get_backlog().push(room.id, serialize_message(chat_message, card))
+    return chat_message
 
 
 @database_sync_to_async
-def create_message(room, user, message):
-    """ Create new ChatMessage object in db """
-    return ChatMessage.objects.create(user=user, room=room, message=message)
+def save_message(room, user, message):
+    """ Create new ChatMessage object in db and count it in its room """
+    with transaction.atomic():
+        chat_message = ChatMessage.objects.create(user=user, room=room,
+                                                  message=message)
+        ChatRoom.objects.record_messages(room.id, 1, chat_message)
+    return chat_message
+
+
+async def get_room_history(room, before=None):
+    """ Return one page of messages (None if db read failed) """
+    backlog = get_backlog()
+    if before is None:
+        # Newest page comes from room backlog
+        page = await backlog.recent(room.id, MESSAGES_PER_PAGE)
+        if page is None:
+            # First join to room since start - warm backlog with one db read
+            page = await get_room_chat_messages(room, count=backlog.size)
+            if page is None:
+                # Not warmed - an empty backlog would hide room's history
+                return None
+            messages, has_more = page
+            await backlog.fill(room.id, messages, has_more)
+            page = (messages[:MESSAGES_PER_PAGE],
+                    has_more or len(messages) > MESSAGES_PER_PAGE)
+    else:
+        # Older pages are rarely read twice so go straight to db
+        page = await get_room_chat_messages(room, before)
+        if page is None:
+            return None
+    messages, has_more = page
+    return {
+        "messages": with_display_time(messages),
+        # Cursor is oldest message sent - client passes it back for next page
+        "before": messages[-1]["id"] if messages else None,
+        "hasMore": has_more
+    }
+
+
+def get_room_chat_messages_sync(room, before=None, count=MESSAGES_PER_PAGE):
+    """ Return (messages, has_more) older than message id before or None """
+    try:
+        # Keyset pagination - walks (room, id) index, never counts or offsets
+        # One query for any page size - user columns come from a join
+        rows, has_more = ChatMessage.objects.page_before(
+            room, before, count, fields=HISTORY_FIELDS)
+        if not has_more:
+            # Rest of room's history (if any) was moved to archive files
+            archived, has_more = RoomArchive(room.id).page_before(
+                rows[-1]["id"] if rows else before, count - len(rows))
+            rows += archived
+        # Messages in dict format (latest first)
+        return encode_history(rows), has_more
+    except Exception:
+        # None rather than empty page so caller doesn't cache a blank room
+        logger.exception("Could not load history for room %s", room.id)
+        return None
 
 
-def get_num_users(room):
-    """ Find total number of users in ChatRoom """
-    return len(room.users.all())
+get_room_chat_messages = database_sync_to_async(get_room_chat_messages_sync)
 
 
 @database_sync_to_async
-def get_room_chat_messages(room):
-    """ Return all or one page of messages from db """
-    try:
-        # Get all messages in room
-        qs = ChatMessage.objects.by_room(room)
-        # Paginate queryset for number of messages per page (hardcoded as 5)
-        pag = Paginator(qs, 5)
-
-        payload = {}
-        if pag.num_pages >= 1:
-            # Use custom serializer to get messages in json format
-            # messages are in reverse order so get page 1
-            ps = PayloadSerializer()
-            payload["messages"] = ps.serialize(pag.page(1).object_list)
-        else:
-            payload["messages"] = "None"
-        # Find last page if db has messages or else page 1
-        payload["pageNum"] = ceil(pag.count / 5) if pag.count > 0 else 1
-        # Put into json format in order to send back to consumer
-        return json.dumps(payload)
-    except Exception as e:
-        print("EXCEPTION: " + str(e))
-        return None
+def search_room_messages(room, query, page):
+    """ Return (messages, has_more) for page of search results in room """
+    return search_room(room, query, page)
+
+
+def get_page_count(count):
+    """ Find last page if room has messages or else page 1 """
+    return ceil(count / MESSAGES_PER_PAGE) if count > 0 else 1
@@ -0,0 +1,53 @@
+""" Run db queries from async code on a bounded pool of db threads """
+import threading
+from asgiref.sync import SyncToAsync
+from channels.db import DatabaseSyncToAsync
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def get_db_executor():
+    """ Process-wide db thread pool from CHAT_DB_POOL (None - one thread) """
+    size = getattr(settings, 'CHAT_DB_POOL', {}).get('SIZE')
+    if not size:
+        return None
+    return ThreadPoolExecutor(max_workers=size,
+                              thread_name_prefix='chat-db')
+
+
+def close_db_connections():
+    """ Close connection each pool thread holds (EX: before dropping db) """
+    executor = get_db_executor()
+    if executor is None:
+        # No pool - queries ran on asgiref's one shared thread
+        SyncToAsync.single_thread_executor.submit(
+            connections.close_all).result()
+        return
+    size = settings.CHAT_DB_POOL['SIZE']
+    # Every thread waits for the rest, so each one runs exactly one close
+    barrier = threading.Barrier(size)
+
+    def close():
+        barrier.wait(timeout=30)
+        connections.close_all()
+
+    for future in [executor.submit(close) for _ in range(size)]:
+        future.result()
+
+
+class PooledDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """ channels' database_sync_to_async, but on CHAT_DB_POOL threads """
+
+    def __init__(self, func):
+        # Each pool thread keeps its own connection open (CONN_MAX_AGE), so
+        # pool size caps connections this worker holds
+        executor = get_db_executor()
+        super().__init__(func, thread_sensitive=executor is None,
+                         executor=executor)
+
+
+# Used like channels.db.database_sync_to_async (as decorator or wrapper)
+database_sync_to_async = PooledDatabaseSyncToAsync
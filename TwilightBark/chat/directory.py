@@ -0,0 +1,161 @@
+""" Rooms ranked by recent activity - updated as messages and joins happen """
+import bisect
+import math
+import time
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from functools import lru_cache
+from .db import database_sync_to_async
+from .models import ChatRoom
+from .presence import get_presence
+from .utils import format_timestamp, load_backend
+
+
+# How much each event adds to room's activity (decays with half_life)
+MESSAGE_WEIGHT = 1.0
+JOIN_WEIGHT = 2.0
+
+# Scores count seconds from here so they stay small (2020-01-01 UTC)
+EPOCH = 1577836800
+
+# Cache key for listing sent to landing page
+DIRECTORY_KEY = 'chat:directory'
+
+
+def log_score(weight, rate, now):
+    """ Event as log score - later events score higher, never rewritten """
+    # Every room decays by same factor, so instead of shrinking old scores
+    # new events are scaled up by exp(rate * age of clock) (kept as log)
+    return math.log(weight) + rate * (now - EPOCH)
+
+
+def log_add(a, b):
+    """ log(exp(a) + exp(b)) without overflowing exp() """
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+class LocalDirectory:
+    """ Per-worker ranking - room id -> log score kept in sorted list """
+
+    def __init__(self, half_life=3600, size=10000):
+        """ half_life is seconds for activity to count half as much """
+        self.rate = math.log(2) / half_life
+        self.size = size
+        self.scores = {}
+        # (log score, room id) - busiest room last
+        self.ranking = []
+
+    async def record(self, room_id, weight=MESSAGE_WEIGHT):
+        """ Add event to room's score and move room to its new rank """
+        score = log_score(weight, self.rate, time.time())
+        old = self.scores.get(room_id)
+        if old is not None:
+            del self.ranking[bisect.bisect_left(self.ranking, (old, room_id))]
+            score = log_add(old, score)
+        self.scores[room_id] = score
+        bisect.insort(self.ranking, (score, room_id))
+        if len(self.ranking) > self.size:
+            # Forget quietest room
+            del self.scores[self.ranking.pop(0)[1]]
+
+    async def top(self, count):
+        """ [(room id, activity now)] for busiest rooms, busiest first """
+        now = self.rate * (time.time() - EPOCH)
+        return [(room_id, math.exp(score - now))
+                for score, room_id in reversed(self.ranking[-count:])]
+
+
+class RedisDirectory:
+    """ Ranking shared between daphne workers in one Redis sorted set """
+
+    # Read-add-write of log score has to happen in one step
+    RECORD_SCRIPT = """
+        local score = tonumber(ARGV[2])
+        local old = redis.call('ZSCORE', KEYS[1], ARGV[1])
+        if old then
+            old = tonumber(old)
+            local high = math.max(old, score)
+            score = high + math.log(1 + math.exp(math.min(old, score) - high))
+        end
+        redis.call('ZADD', KEYS[1], string.format('%.17g', score), ARGV[1])
+        redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, half_life=3600,
+                 size=10000, key='directory'):
+        """ Every worker must use same half_life """
+        import redis
+        self.redis = redis.Redis(host=host, port=port, db=db)
+        self.rate = math.log(2) / half_life
+        self.size = size
+        self.key = key
+        self.record_script = self.redis.register_script(self.RECORD_SCRIPT)
+
+    async def record(self, room_id, weight=MESSAGE_WEIGHT):
+        """ Add event to room's score and move room to its new rank """
+        score = log_score(weight, self.rate, time.time())
+        await sync_to_async(self.record_script, thread_sensitive=False)(
+            keys=[self.key], args=[room_id, repr(score), self.size])
+
+    async def top(self, count):
+        """ [(room id, activity now)] for busiest rooms, busiest first """
+        rows = await sync_to_async(self.redis.zrevrange,
+                                   thread_sensitive=False)(
+            self.key, 0, count - 1, withscores=True)
+        now = self.rate * (time.time() - EPOCH)
+        return [(int(room_id), math.exp(score - now))
+                for room_id, score in rows]
+
+
+@lru_cache(maxsize=None)
+def get_directory():
+    """ Return process-wide ranking backend defined by CHAT_DIRECTORY """
+    return load_backend('CHAT_DIRECTORY', 'chat.directory.LocalDirectory')
+
+
+def get_listing():
+    """ Busiest rooms for landing page - rebuilt at most once per TTL """
+    listing = cache.get(DIRECTORY_KEY)
+    if listing is None:
+        config = getattr(settings, 'CHAT_DIRECTORY', {})
+        listing = async_to_sync(build_listing)(config.get('ROOMS', 20))
+        cache.set(DIRECTORY_KEY, listing, config.get('TTL', 10))
+    return listing
+
+
+async def build_listing(count):
+    """ Ranked rooms with their counters and number of users connected """
+    ranked = await get_directory().top(count)
+    listing = await load_rooms(ranked, count)
+    presence = get_presence()
+    for room in listing:
+        room['online'] = await presence.count(room.pop('id'))
+    return listing
+
+
+@database_sync_to_async
+def load_rooms(ranked, count):
+    """ Rows for ranked room ids, topped up with last rooms to get messages """
+    fields = ('id', 'name', 'message_count', 'last_message_at')
+    rooms = {room['id']: room for room in ChatRoom.objects
+             .filter(id__in=[room_id for room_id, _ in ranked])
+             .values(*fields)}
+    # Deleted rooms can still be ranked - skip them
+    ranked = [(rooms[room_id], activity) for room_id, activity in ranked
+              if room_id in rooms]
+    if len(ranked) < count:
+        # Ranking is empty after restart until rooms get busy again
+        recent = (ChatRoom.objects.filter(last_message_at__isnull=False)
+                  .exclude(id__in=rooms).order_by('-last_message_at')
+                  .values(*fields)[:count - len(ranked)])
+        ranked += [(room, 0.0) for room in recent]
+    return [{
+        'id': room['id'],
+        'name': room['name'],
+        'messages': room['message_count'],
+        'lastMessageAt': (format_timestamp(room['last_message_at'])
+                          if room['last_message_at'] else None),
+        'activity': round(activity, 2),
+    } for room, activity in ranked]
@@ -0,0 +1,186 @@
+""" Channel layer that skips Redis for sockets served by this same worker """
+import asyncio
+import contextvars
+import logging
+import time
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+from .limits import counters
+
+
+logger = logging.getLogger(__name__)
+
+# Sent through Redis when a worker gets its first member of a group, so
+# workers that were skipping Redis for that group start using it again
+MEMBER_NOTICE = 'hybrid.member_notice'
+
+# (group, notices seen when send started) while a Redis group send runs
+sending = contextvars.ContextVar('sending', default=None)
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    """ Redis layer that hands messages to this worker's channels in memory """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # group -> {local channel name: time added} - this worker's members
+        self.local_groups = {}
+        # group -> whether group has members on other workers (for groups
+        # with local members) - missing means unknown, so Redis is used
+        self.remote_groups = {}
+        # Member notices received - a send that started before one came in
+        # can't tell group has no remote members
+        self.notices = 0
+        # Redis read for this worker's channels - kept running across calls
+        # so a message handed over in memory doesn't cancel it
+        self.remote_receive = None
+        self.receive_loop = None
+        # Set when a message is handed over in memory (see receive_single)
+        self.local_delivered = None
+
+    def is_local(self, channel):
+        """ Whether channel was made by this layer (so receive runs here) """
+        if "!" not in channel:
+            return False
+        # Specific channels are named "specific.<client prefix>!<random>"
+        return self.non_local_name(channel).endswith(self.client_prefix + "!")
+
+    def deliver_local(self, channel, message):
+        """ Put message where receive() reads it - False if channel is full """
+        queue = self.receive_buffer[channel]
+        if queue.qsize() >= self.get_capacity(channel):
+            return False
+        # Copy so one consumer changing its message can't affect another
+        queue.put_nowait(dict(message))
+        if self.local_delivered is not None:
+            self.local_delivered.set()
+        return True
+
+    async def receive_single(self, channel):
+        """ Next Redis message for worker (or none if one came in memory) """
+        if not channel.endswith(self.client_prefix + "!"):
+            return await super().receive_single(channel)
+        loop = asyncio.get_event_loop()
+        if self.receive_loop != loop:
+            # First receive (or layer reused from another loop in tests)
+            self.receive_loop = loop
+            self.remote_receive = None
+            self.local_delivered = asyncio.Event()
+        if self.remote_receive is None:
+            self.remote_receive = asyncio.ensure_future(
+                super().receive_single(channel))
+        # Whoever waits here holds receive lock and isn't watching buffers -
+        # wake it for local messages too, else they wait on Redis timeout
+        woken = asyncio.ensure_future(self.local_delivered.wait())
+        try:
+            await asyncio.wait([self.remote_receive, woken],
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            woken.cancel()
+        if self.remote_receive.done():
+            remote_receive, self.remote_receive = self.remote_receive, None
+            return self.read_notice(*remote_receive.result())
+        self.local_delivered.clear()
+        # Empty channel list - receive() stores nothing and checks buffer again
+        return [], None
+
+    def read_notice(self, channel, message):
+        """ Count member notices from other workers - never passed on """
+        if message.get("type") != MEMBER_NOTICE:
+            return channel, message
+        # Another worker now has members - its sends must go through Redis
+        self.notices += 1
+        if message["group"] in self.local_groups:
+            self.remote_groups[message["group"]] = True
+        return [], None
+
+    async def send(self, channel, message):
+        """ Send to one channel - skips Redis if channel is in this worker """
+        if not self.is_local(channel):
+            return await super().send(channel, message)
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if not self.deliver_local(channel, message):
+            raise ChannelFull()
+
+    async def group_add(self, group, channel):
+        """ Join group in Redis (for other workers) and in local members """
+        await super().group_add(group, channel)
+        if self.is_local(channel):
+            members = self.local_groups.setdefault(group, {})
+            first = not members
+            members[channel] = time.time()
+            if first:
+                # Other workers may be skipping Redis for this group - tell
+                # them (and learn whether they have members here too)
+                await self.send_remote(group, {"type": MEMBER_NOTICE,
+                                               "group": group})
+
+    async def group_discard(self, group, channel):
+        """ Leave group in Redis and in local members """
+        members = self.local_groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                # Drop empty groups so dict doesn't grow with every room
+                del self.local_groups[group]
+                self.remote_groups.pop(group, None)
+        await super().group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        """ Deliver to local members now, then remote members through Redis """
+        assert self.valid_group_name(group), "Group name not valid"
+        members = self.local_groups.get(group, {})
+        # Same expiry Redis applies to members that never left
+        expired = time.time() - self.group_expiry
+        over_capacity = 0
+        for channel, added in list(members.items()):
+            if added < expired:
+                del members[channel]
+            elif not self.deliver_local(channel, message):
+                over_capacity += 1
+        if over_capacity:
+            counters['frames_dropped'] += over_capacity
+            logger.info("%s of %s local channels over capacity in group %s",
+                        over_capacity, len(members), group)
+        # Skipped when every member is on this worker - no Redis round trip
+        if self.remote_groups.get(group, True):
+            await self.send_remote(group, message)
+
+    async def send_remote(self, group, message):
+        """ Send to group's members on other workers through Redis """
+        token = sending.set((group, self.notices))
+        try:
+            # Redis still lists every member - local ones filtered out below
+            await super().group_send(group, message)
+        finally:
+            sending.reset(token)
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        """ Only members on other workers get group messages through Redis """
+        remote = [channel for channel in channel_names
+                  if not self.is_local(channel)]
+        group, notices = sending.get() or (None, None)
+        if group in self.local_groups:
+            # Member list was just read from Redis - remember if it had
+            # remote members, unless a member notice came in meanwhile
+            if remote or notices == self.notices:
+                self.remote_groups[group] = bool(remote)
+        if message.get("type") == MEMBER_NOTICE:
+            # Only hybrid workers' own channels read notices
+            remote = [channel for channel in remote if "!" in channel]
+        return super()._map_channel_keys_to_connection(remote, message)
+
+    async def close_pools(self):
+        """ Stop Redis read left running by receive_single, then close """
+        if self.remote_receive is not None:
+            self.remote_receive.cancel()
+            await asyncio.wait([self.remote_receive])
+            self.remote_receive = None
+        await super().close_pools()
+
+    async def flush(self):
+        """ Delete all messages and groups (local members too) """
+        self.local_groups.clear()
+        self.remote_groups.clear()
+        await super().flush()
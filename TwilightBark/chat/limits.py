@@ -0,0 +1,63 @@
+""" Keep one spammy client from hurting everyone else in a room """
+import time
+from collections import Counter, OrderedDict
+from django.conf import settings
+from functools import lru_cache
+
+
+# Process-wide totals - rate_limited, and frames_dropped (group messages
+# chat.layers.HybridChannelLayer couldn't hand to a full local channel)
+counters = Counter()
+
+
+class RateLimiter:
+    """ Token bucket per (room, sender) - rate tokens/second up to burst """
+
+    def __init__(self, rate=1.0, burst=5, rooms=None, size=10000):
+        """ rooms maps room name -> {'RATE': .., 'BURST': ..} overrides """
+        self.rate = rate
+        self.burst = burst
+        self.rooms = rooms or {}
+        self.size = size
+        # (room name, sender) -> (tokens left, time counted) - LRU order
+        self.buckets = OrderedDict()
+
+    def limits(self, room_name):
+        """ Return (rate, burst) for room - busy rooms can be stricter """
+        config = self.rooms.get(room_name, {})
+        return (config.get('RATE', self.rate),
+                config.get('BURST', self.burst))
+
+    def allow(self, room_name, sender):
+        """ Take one token for sender in room - False if bucket is empty """
+        rate, burst = self.limits(room_name)
+        key = (room_name, sender)
+        now = time.monotonic()
+        tokens, counted = self.buckets.pop(key, (burst, now))
+        # Refill for time since last frame, never past burst
+        tokens = min(burst, tokens + (now - counted) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            counters['rate_limited'] += 1
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.size:
+            # Oldest bucket has had longest to refill - forgetting it is safe
+            self.buckets.popitem(last=False)
+        return allowed
+
+
+@lru_cache(maxsize=None)
+def get_limiter():
+    """ Return process-wide rate limiter configured by CHAT_RATE_LIMIT """
+    config = getattr(settings, 'CHAT_RATE_LIMIT', {})
+    return RateLimiter(config.get('RATE', 1.0), config.get('BURST', 5),
+                       config.get('ROOMS', {}))
+
+
+@lru_cache(maxsize=None)
+def get_read_limiter():
+    """ Separate limiter for history and search (CHAT_RATE_LIMIT READS) """
+    config = getattr(settings, 'CHAT_RATE_LIMIT', {}).get('READS', {})
+    return RateLimiter(config.get('RATE', 5.0), config.get('BURST', 20))
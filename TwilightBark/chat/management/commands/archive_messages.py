@@ -0,0 +1,44 @@
+""" Move old messages to archive files - python3 manage.py archive_messages """
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from chat.archive import archive_room, retention_config, retention_days
+from chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    """ Archive messages older than each room's retention (CHAT_RETENTION) """
+    help = ('Move messages older than CHAT_RETENTION days out of the '
+            'database into compressed per-room archive files. Run it '
+            'daily (EX: from cron)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('rooms', nargs='*',
+                            help='Room names to archive (default all rooms)')
+        parser.add_argument('--days', type=int,
+                            help='Override retention days for this run')
+
+    def handle(self, *args, **options):
+        """ Archive rooms one at a time and report messages moved """
+        config = retention_config()
+        rooms = ChatRoom.objects.order_by('id')
+        if options['rooms']:
+            rooms = rooms.filter(name__in=options['rooms'])
+            missing = set(options['rooms']) - {room.name for room in rooms}
+            if missing:
+                raise CommandError(f'Unknown rooms: {", ".join(missing)}')
+        total = 0
+        for room in rooms.iterator():
+            days = options['days']
+            if days is None:
+                days = retention_days(room.name)
+            if days is None:
+                # Room kept in db forever
+                continue
+            cutoff = timezone.now() - timedelta(days=days)
+            moved = archive_room(room, cutoff, config['SEGMENT_SIZE'],
+                                 config['COMPRESSION'])
+            if moved:
+                total += moved
+                self.stdout.write(f'{room.name}: archived {moved} messages')
+        self.stdout.write(f'Archived {total} message(s)')
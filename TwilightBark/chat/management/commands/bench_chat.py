@@ -0,0 +1,310 @@
+""" Load test ChatConsumer - python3 manage.py bench_chat """
+import asyncio
+import contextvars
+import json
+import time
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from django.urls import path
+from chat.consumers import ChatConsumer
+from chat.db import close_db_connections, database_sync_to_async
+from chat.limits import counters, get_limiter, get_read_limiter
+from chat.writer import get_writer
+from user.models import User
+
+
+# Metrics where a bigger number is better - everything else is a cost
+HIGHER_IS_BETTER = {'messages_per_sec', 'frames_per_sec'}
+
+# Handler currently running - db queries are counted against it
+current_handler = contextvars.ContextVar('current_handler', default=None)
+
+
+class QueryCounter:
+    """ Count db queries per consumer handler on every db connection """
+
+    def __init__(self):
+        self.queries = {}
+        self.calls = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        """ Execute wrapper - runs in whichever thread does the query """
+        handler = current_handler.get()
+        if handler:
+            self.queries[handler] = self.queries.get(handler, 0) + 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        """ Wrap connection (also called for connections opened later) """
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def per_call(self):
+        """ Average number of queries per handler call """
+        return {handler: round(self.queries.get(handler, 0) / calls, 2)
+                for handler, calls in self.calls.items()}
+
+
+def timed_handler(counter, name, handler):
+    """ Wrap consumer handler so its db queries are counted under name """
+    async def wrapper(self, *args, **kwargs):
+        token = current_handler.set(name)
+        counter.calls[name] = counter.calls.get(name, 0) + 1
+        try:
+            return await handler(self, *args, **kwargs)
+        finally:
+            current_handler.reset(token)
+    return wrapper
+
+
+def percentile(values, pct):
+    """ Value below which pct percent of values fall (nearest rank) """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Command(BaseCommand):
+    """ Simulate rooms x clients x messages against ChatConsumer """
+    help = ('Benchmark ChatConsumer with R rooms x C clients sending '
+            'messages at a fixed rate, on a throwaway test database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=2)
+        parser.add_argument('--clients', type=int, default=5,
+                            help='Clients per room (all logged in)')
+        parser.add_argument('--messages', type=int, default=10,
+                            help='Messages sent by each client')
+        parser.add_argument('--rate', type=float, default=20.0,
+                            help='Messages per second sent by each client')
+        parser.add_argument('--layer', choices=['memory', 'redis', 'hybrid'],
+                            default='memory',
+                            help='InMemoryChannelLayer, a local Redis, or '
+                                 'Redis with in-process delivery')
+        parser.add_argument('--redis-host', default='localhost')
+        parser.add_argument('--redis-port', type=int, default=6379)
+        parser.add_argument('--save-baseline', metavar='FILE',
+                            help='Write results as json baseline')
+        parser.add_argument('--baseline', metavar='FILE',
+                            help='Fail if results regress past baseline')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed regression vs baseline (0.25=25%%)')
+
+    def handle(self, *args, **options):
+        """ Run benchmark on test db, print report and compare baseline """
+        if options['layer'] in ('redis', 'hybrid'):
+            layer = {
+                'BACKEND': ('chat.layers.HybridChannelLayer'
+                            if options['layer'] == 'hybrid' else
+                            'channels_redis.core.RedisChannelLayer'),
+                'CONFIG': {'hosts': [(options['redis_host'],
+                                      options['redis_port'])]},
+            }
+        else:
+            layer = {'BACKEND': 'channels.layers.InMemoryChannelLayer'}
+
+        # Never touch real data - build and drop a test database
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True,
+                                                      serialize=False)
+        counter = QueryCounter()
+        connection_created.connect(counter.install)
+        for conn in connections.all():
+            counter.install(connection=conn)
+        # Bench clients send faster than real users may - don't throttle them
+        rate_limit = {'RATE': options['rate'] * 2,
+                      'BURST': options['messages'] + 2}
+        try:
+            with override_settings(CHANNEL_LAYERS={'default': layer},
+                                   CHAT_RATE_LIMIT=rate_limit):
+                get_limiter.cache_clear()
+                get_read_limiter.cache_clear()
+                results = asyncio.run(self.run_benchmark(options, counter))
+        finally:
+            get_limiter.cache_clear()
+            get_read_limiter.cache_clear()
+            connection_created.disconnect(counter.install)
+            # Pool threads keep their connections open (CONN_MAX_AGE)
+            close_db_connections()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.report(results)
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write(f"Baseline saved to {options['save_baseline']}")
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    async def run_benchmark(self, options, counter):
+        """ Connect every client, send messages, load history, disconnect """
+        rooms, clients = options['rooms'], options['clients']
+        users = await create_users(rooms * clients)
+        counters.clear()
+
+        # Same consumer with handlers wrapped to count their db queries
+        consumer = type('BenchConsumer', (ChatConsumer,), {
+            name: timed_handler(counter, name, getattr(ChatConsumer, name))
+            for name in ('connect', 'receive', 'load_older', 'disconnect')
+        })
+        application = URLRouter([
+            path('ws/chat/<room_name>/', consumer.as_asgi()),
+        ])
+
+        # Connect everyone - time until backlog arrives is connect time
+        connect_times = []
+        sockets = []
+        for room in range(rooms):
+            for client in range(clients):
+                socket = WebsocketCommunicator(application,
+                                               f'/ws/chat/bench{room}/')
+                socket.scope['user'] = users[room * clients + client]
+                start = time.perf_counter()
+                connected, _ = await socket.connect()
+                if not connected:
+                    raise CommandError('Websocket connection was refused')
+                await next_frame(socket, 'load_messages')
+                connect_times.append(time.perf_counter() - start)
+                sockets.append((room, socket))
+
+        # Every client sends at rate while all clients read what arrives
+        sent_at = {}
+        latencies = []
+        expected = clients * options['messages']
+        start = time.perf_counter()
+        readers = []
+        senders = []
+        for index, (_, socket) in enumerate(sockets):
+            readers.append(asyncio.ensure_future(
+                read_messages(socket, expected, sent_at, latencies)))
+            senders.append(asyncio.ensure_future(
+                send_messages(socket, index, options['messages'],
+                              options['rate'], sent_at)))
+        await asyncio.gather(*senders)
+        await asyncio.gather(*readers)
+        elapsed = time.perf_counter() - start
+
+        # One page of older history per client (cursor from newest message)
+        history_times = []
+        for _, socket in sockets:
+            start_history = time.perf_counter()
+            await socket.send_to(text_data=json.dumps({
+                'command': 'load_older', 'before': 2 ** 31}))
+            await next_frame(socket, 'older_messages')
+            history_times.append(time.perf_counter() - start_history)
+
+        for _, socket in sockets:
+            await socket.disconnect()
+        writer = get_writer()
+        if writer:
+            await writer.flush()
+
+        # load_older runs inside receive - only count chat sends as receive
+        counter.calls['receive'] -= counter.calls.get('load_older', 0)
+        sent = len(sockets) * options['messages']
+        return {
+            'connect_p50_ms': ms(percentile(connect_times, 50)),
+            'connect_p99_ms': ms(percentile(connect_times, 99)),
+            'broadcast_p50_ms': ms(percentile(latencies, 50)),
+            'broadcast_p99_ms': ms(percentile(latencies, 99)),
+            'history_p50_ms': ms(percentile(history_times, 50)),
+            'messages_per_sec': round(sent / elapsed, 1),
+            'frames_per_sec': round(len(latencies) / elapsed, 1),
+            'queries_per_call': counter.per_call(),
+            # Rate limited frames and group messages dropped for full
+            # channels (counted by hybrid layer only)
+            'limits': {name: counters[name] for name in (
+                'rate_limited', 'frames_dropped')},
+        }
+
+    def report(self, results):
+        """ Print results as aligned table """
+        for key, value in sorted(results.items()):
+            if isinstance(value, dict):
+                for handler, queries in sorted(value.items()):
+                    self.stdout.write(f'{key}.{handler:<24} {queries}')
+            else:
+                self.stdout.write(f'{key:<35} {value}')
+
+    def compare(self, results, baseline_file, tolerance):
+        """ Raise CommandError listing every metric worse than baseline """
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        regressions = []
+        for key, old, new in flatten(baseline, results):
+            if key.split('.')[0] in HIGHER_IS_BETTER:
+                worse = new < old * (1 - tolerance)
+            else:
+                # Small absolute slack so sub-ms timings don't flap in CI
+                worse = new > old * (1 + tolerance) + 0.5
+            if worse:
+                regressions.append(f'{key}: {old} -> {new}')
+        if regressions:
+            raise CommandError('Regressions against baseline:\n' +
+                               '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS('No regressions vs baseline'))
+
+
+@database_sync_to_async
+def create_users(count):
+    """ Bulk create logged-in bench users (unusable password - no hashing) """
+    password = make_password(None)
+    User.objects.bulk_create([
+        # bulk_create skips save() - fill email_lower by hand
+        User(email=f'bench{i}@bench.test', email_lower=f'bench{i}@bench.test',
+             username=f'bench{i}', password=password)
+        for i in range(count)])
+    return list(User.objects.filter(email__endswith='@bench.test')
+                .order_by('id'))
+
+
+async def next_frame(socket, frame_type, timeout=30):
+    """ Read frames until one of frame_type arrives (skips presence etc) """
+    while True:
+        # Read queue directly - receive_from kills app when it times out
+        message = await asyncio.wait_for(socket.output_queue.get(), timeout)
+        frame = json.loads(message.get('text') or '{}')
+        if frame_type in (frame.get('type'), frame.get('msg_type')):
+            return frame
+
+
+async def send_messages(socket, client, count, rate, sent_at):
+    """ Send count messages at rate per second, remembering send time """
+    for index in range(count):
+        text = f'bench {client} {index}'
+        sent_at[text] = time.perf_counter()
+        await socket.send_to(text_data=json.dumps({'message': text}))
+        await asyncio.sleep(1 / rate)
+
+
+async def read_messages(socket, expected, sent_at, latencies):
+    """ Read expected chat frames, recording latency since each was sent """
+    received = 0
+    while received < expected:
+        frame = await next_frame(socket, 'message')
+        latencies.append(time.perf_counter() - sent_at[frame['message']])
+        received += 1
+
+
+def ms(seconds):
+    """ Seconds to milliseconds rounded for report """
+    return round(seconds * 1000, 2)
+
+
+def flatten(baseline, results):
+    """ Yield (key, old, new) for every metric in both baseline and results """
+    for key, old in baseline.items():
+        new = results.get(key)
+        if isinstance(old, dict) and isinstance(new, dict):
+            for name, value in old.items():
+                if name in new:
+                    yield f'{key}.{name}', value, new[name]
+        elif isinstance(old, (int, float)) and isinstance(new, (int, float)):
+            yield key, old, new
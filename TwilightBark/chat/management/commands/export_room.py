@@ -0,0 +1,139 @@
+""" Stream room history to file - python3 manage.py export_room <room> """
+import csv
+import gzip
+import io
+import json
+import sys
+from contextlib import ExitStack
+from datetime import datetime, time
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from chat.archive import RoomArchive
+from chat.models import ChatMessage, ChatRoom
+from user.models import User
+
+
+# Columns written for every message (csv header and jsonl keys)
+EXPORT_FIELDS = ('id', 'timestamp', 'user_id', 'username', 'message')
+
+
+def parse_time(value):
+    """ Aware datetime from '2026-01-31' or '2026-01-31T12:00' argument """
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        moment = datetime.combine(day, time())
+    if timezone.is_naive(moment):
+        # Same time zone as times shown in chat (TIME_ZONE)
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def chunked(rows, size):
+    """ Yield lists of up to size rows """
+    rows = iter(rows)
+    chunk = list(islice(rows, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, size))
+
+
+class Command(BaseCommand):
+    """ Write room's messages (archive then db) oldest first as jsonl/csv """
+    help = ('Export every message in a room, including archived messages, '
+            'as JSON lines or CSV. Rows are streamed so memory use stays '
+            'flat however big the room is')
+
+    def add_arguments(self, parser):
+        parser.add_argument('room', help='Room name')
+        parser.add_argument('--format', choices=['jsonl', 'csv'],
+                            default='jsonl')
+        parser.add_argument('--output', default='-',
+                            help='File to write (default stdout)')
+        parser.add_argument('--gzip', action='store_true',
+                            help='Compress output (on for .gz files)')
+        parser.add_argument('--since',
+                            help='Only messages at or after this date/time')
+        parser.add_argument('--until',
+                            help='Only messages before this date/time')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Rows read from db at a time')
+        parser.add_argument('--no-archive', action='store_true',
+                            help='Skip messages moved to archive files')
+
+    def handle(self, *args, **options):
+        """ Open output and write archived rows then db rows """
+        try:
+            room = ChatRoom.objects.get(name=options['room'])
+        except ChatRoom.DoesNotExist:
+            raise CommandError(f"Unknown room: {options['room']}")
+        try:
+            since = options['since'] and parse_time(options['since'])
+            until = options['until'] and parse_time(options['until'])
+        except ValueError as e:
+            raise CommandError(f'Invalid date/time: {e}')
+        output = options['output']
+        with ExitStack() as stack:
+            if output == '-':
+                raw = sys.stdout.buffer
+            else:
+                raw = stack.enter_context(open(output, 'wb'))
+            if options['gzip'] or output.endswith('.gz'):
+                # Closed before file so gzip trailer is written
+                raw = stack.enter_context(gzip.GzipFile(fileobj=raw,
+                                                        mode='wb'))
+            # newline='' so csv module controls line endings
+            stream = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+            # Detached on exit so stdout isn't closed with wrapper
+            stack.callback(stream.detach)
+            stack.callback(stream.flush)
+            count = self.write_rows(stream, room, since, until, options)
+        self.stderr.write(f'Exported {count} message(s) from {room.name}')
+
+    def write_rows(self, stream, room, since, until, options):
+        """ Write header (csv) and every row - return rows written """
+        if options['format'] == 'csv':
+            writer = csv.writer(stream)
+            writer.writerow(EXPORT_FIELDS)
+            write = writer.writerow
+        else:
+            def write(row):
+                stream.write(json.dumps(dict(zip(EXPORT_FIELDS, row)),
+                                        ensure_ascii=False) + '\n')
+        count = 0
+        for row in self.rows(room, since, until, options):
+            write(row)
+            count += 1
+        return count
+
+    def rows(self, room, since, until, options):
+        """ Yield (id, time, user id, username, message) oldest first """
+        archive = RoomArchive(room.id)
+        if not options['no_archive']:
+            for chunk in chunked(archive.rows(since, until),
+                                 options['chunk_size']):
+                # One username query per chunk of archived rows
+                names = dict(User.objects.filter(
+                    id__in={row['user_id'] for row in chunk})
+                    .values_list('id', 'username'))
+                for row in chunk:
+                    yield (row['id'], row['timestamp'].isoformat(),
+                           row['user_id'], names.get(row['user_id'], ''),
+                           row['message'])
+        # Walks (room, id) index - rows still in db after archived ones
+        queryset = ChatMessage.objects.filter(room=room,
+                                              id__gt=archive.last_id())
+        if since:
+            queryset = queryset.filter(timestamp__gte=since)
+        if until:
+            queryset = queryset.filter(timestamp__lt=until)
+        rows = (queryset.order_by('id')
+                .values_list('id', 'timestamp', 'user_id', 'user__username',
+                             'message')
+                .iterator(chunk_size=options['chunk_size']))
+        for id, timestamp, user_id, username, message in rows:
+            yield id, timestamp.isoformat(), user_id, username, message
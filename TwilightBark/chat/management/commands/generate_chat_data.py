@@ -0,0 +1,153 @@
+""" Fill db with fake chat data - python3 manage.py generate_chat_data """
+import random
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import accumulate
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from chat.models import ChatMessage, ChatRoom
+from user.models import User
+
+
+# Words fake messages are made of
+WORDS = ('angel', 'bark', 'woof', 'dog', 'dogs', 'puppy', 'walk', 'park',
+         'ball', 'fetch', 'treat', 'treats', 'good', 'girl', 'boy', 'sit',
+         'stay', 'howl', 'twilight', 'collie', 'border', 'tail', 'wag',
+         'leash', 'squirrel', 'cat', 'bone', 'nap', 'dinner', 'breakfast',
+         'the', 'a', 'is', 'my', 'your', 'and', 'to', 'at', 'who', 'so',
+         'very', 'today', 'tonight', 'outside', 'again', 'loves', 'wants',
+         'found', 'chased', 'barked', 'hello', 'everyone', 'lol', 'yes')
+
+
+def zipf_weights(count, skew):
+    """ Cumulative weights where item n is picked 1/(n+1)^skew as often """
+    # First items are hot, rest are a long tail
+    return list(accumulate(1 / (rank + 1) ** skew for rank in range(count)))
+
+
+@contextmanager
+def keep_timestamps():
+    """ Let bulk_create save given message times instead of now """
+    field = ChatMessage._meta.get_field('timestamp')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+class Command(BaseCommand):
+    """ Bulk create users, rooms and skewed messages for benchmarks """
+    help = ('Generate users, rooms and messages in batches. Messages pick '
+            'rooms and authors with Zipf skew (a few hot rooms and a long '
+            'tail) and the same seed always makes the same data')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--rooms', type=int, default=100)
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Zipf exponent for rooms and authors '
+                                 '(0 is uniform)')
+        parser.add_argument('--days', type=float, default=30,
+                            help='Messages spread evenly over last N days')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='synth',
+                            help='Start of generated usernames/room names')
+        parser.add_argument('--password', default='synth-password',
+                            help='Password every generated user logs in with')
+
+    def handle(self, *args, **options):
+        """ Create users and rooms, then messages batch by batch """
+        prefix = options['prefix']
+        if (User.objects.filter(email__endswith=f'@{prefix}.test').exists()
+                or ChatRoom.objects.filter(
+                    name__startswith=f'{prefix}-').exists()):
+            raise CommandError(f'Data with prefix {prefix} already exists - '
+                               'use another --prefix')
+        if min(options['users'], options['rooms']) < 1:
+            raise CommandError('Need at least one user and one room')
+        rng = random.Random(options['seed'])
+        start = time.perf_counter()
+        users = self.create_users(prefix, options['users'],
+                                  options['password'], options['batch_size'])
+        rooms = self.create_rooms(prefix, options['rooms'],
+                                  options['batch_size'])
+        self.stdout.write(f'Created {len(users)} users and {len(rooms)} '
+                          f'rooms in {time.perf_counter() - start:.1f}s')
+        # Shuffled so hot users aren't just the first ones created
+        rng.shuffle(users)
+        start = time.perf_counter()
+        with keep_timestamps():
+            self.create_messages(rng, users, rooms, options)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"Created {options['messages']} messages in "
+                          f"{elapsed:.1f}s "
+                          f"({options['messages'] / elapsed:.0f}/s)")
+
+    def create_users(self, prefix, count, password, batch_size):
+        """ Bulk create users sharing one password hash - return ids """
+        # Hashing once - a hash per user would take longer than the inserts
+        password = make_password(password)
+        for first in range(0, count, batch_size):
+            User.objects.bulk_create([
+                # bulk_create skips save() - fill email_lower by hand
+                User(email=f'{prefix}{i}@{prefix}.test',
+                     email_lower=f'{prefix}{i}@{prefix}.test',
+                     username=f'{prefix}{i}', password=password)
+                for i in range(first, min(first + batch_size, count))])
+        return list(User.objects.filter(email__endswith=f'@{prefix}.test')
+                    .order_by('id').values_list('id', flat=True))
+
+    def create_rooms(self, prefix, count, batch_size):
+        """ Bulk create rooms - return ids (hottest room first) """
+        ChatRoom.objects.bulk_create(
+            [ChatRoom(name=f'{prefix}-room-{i}') for i in range(count)],
+            batch_size=batch_size)
+        return list(ChatRoom.objects.filter(name__startswith=f'{prefix}-')
+                    .order_by('id').values_list('id', flat=True))
+
+    def create_messages(self, rng, users, rooms, options):
+        """ Insert messages oldest first and update room counters at end """
+        total, batch_size = options['messages'], options['batch_size']
+        room_weights = zipf_weights(len(rooms), options['skew'])
+        user_weights = zipf_weights(len(users), options['skew'])
+        span = timedelta(days=options['days'])
+        first_at = timezone.now() - span
+        # room id -> [messages, newest message]
+        counters = {}
+        for first in range(0, total, batch_size):
+            count = min(batch_size, total - first)
+            batch = [ChatMessage(
+                room_id=room_id, user_id=user_id,
+                message=' '.join(rng.choices(WORDS,
+                                             k=rng.randint(1, 20))),
+                # Evenly spaced so ids and times are in same order
+                timestamp=first_at + span * ((first + i) / total))
+                for i, (room_id, user_id) in enumerate(zip(
+                    rng.choices(rooms, cum_weights=room_weights, k=count),
+                    rng.choices(users, cum_weights=user_weights, k=count)))]
+            with transaction.atomic():
+                ChatMessage.objects.bulk_create(batch)
+                if batch[0].pk is None:
+                    # Backend can't return ids (sqlite) - ids are consecutive
+                    # since transaction holds write lock (as chat.writer)
+                    last_id = (ChatMessage.objects.order_by('-id')
+                               .values_list('id', flat=True).first())
+                    for offset, message in enumerate(reversed(batch)):
+                        message.pk = last_id - offset
+            for message in batch:
+                counter = counters.setdefault(message.room_id, [0, None])
+                counter[0] += 1
+                counter[1] = message
+            self.stdout.write(f'{first + count}/{total} messages',
+                              ending='\r')
+        self.stdout.write('')
+        with transaction.atomic():
+            for room_id, (count, last_message) in counters.items():
+                ChatRoom.objects.record_messages(room_id, count,
+                                                 last_message)
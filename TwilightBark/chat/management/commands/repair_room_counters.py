@@ -0,0 +1,37 @@
+""" Recount room message counters - python3 manage.py repair_room_counters """
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    """ Rebuild ChatRoom message_count and last message from messages """
+    help = ('Recount messages for every room (or the rooms named) and fix '
+            'message_count, last_message_id and last_message_at')
+
+    def add_arguments(self, parser):
+        parser.add_argument('rooms', nargs='*',
+                            help='Room names to repair (default all rooms)')
+
+    def handle(self, *args, **options):
+        """ Repair rooms one at a time so writers are only held up briefly """
+        rooms = ChatRoom.objects.order_by('id')
+        if options['rooms']:
+            rooms = rooms.filter(name__in=options['rooms'])
+            missing = set(options['rooms']) - set(
+                rooms.values_list('name', flat=True))
+            if missing:
+                raise CommandError(f'Unknown rooms: {", ".join(missing)}')
+        fixed = 0
+        for room in rooms.values('id', 'name', 'message_count',
+                                 'last_message_id').iterator():
+            # Recount and save inside room's row lock
+            with transaction.atomic():
+                repaired = ChatRoom.objects.rebuild_counters(room['id'])
+            if (repaired.message_count, repaired.last_message_id) != (
+                    room['message_count'], room['last_message_id']):
+                fixed += 1
+                self.stdout.write(
+                    f"{room['name']}: {room['message_count']} -> "
+                    f"{repaired.message_count} messages")
+        self.stdout.write(f'Repaired {fixed} room(s)')
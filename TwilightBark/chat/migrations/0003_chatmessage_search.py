@@ -0,0 +1,91 @@
+# Full-text index over ChatMessage.message - see chat/search.py
+
+from django.db import migrations
+
+
+# SQLite - external content FTS5 table (stores only the index, text stays in
+# chat_chatmessage) kept in sync by triggers, so bulk_create is covered too
+SQLITE_CREATE = [
+    """CREATE VIRTUAL TABLE chat_chatmessage_fts USING fts5(
+        message, content='chat_chatmessage', content_rowid='id',
+        tokenize='porter unicode61')""",
+    """CREATE TRIGGER chat_chatmessage_fts_insert
+        AFTER INSERT ON chat_chatmessage BEGIN
+        INSERT INTO chat_chatmessage_fts(rowid, message)
+            VALUES (new.id, new.message);
+    END""",
+    """CREATE TRIGGER chat_chatmessage_fts_delete
+        AFTER DELETE ON chat_chatmessage BEGIN
+        INSERT INTO chat_chatmessage_fts(chat_chatmessage_fts, rowid, message)
+            VALUES ('delete', old.id, old.message);
+    END""",
+    """CREATE TRIGGER chat_chatmessage_fts_update
+        AFTER UPDATE OF message ON chat_chatmessage BEGIN
+        INSERT INTO chat_chatmessage_fts(chat_chatmessage_fts, rowid, message)
+            VALUES ('delete', old.id, old.message);
+        INSERT INTO chat_chatmessage_fts(rowid, message)
+            VALUES (new.id, new.message);
+    END""",
+    # Index messages already in db
+    """INSERT INTO chat_chatmessage_fts(chat_chatmessage_fts)
+        VALUES ('rebuild')""",
+]
+
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS chat_chatmessage_fts_insert",
+    "DROP TRIGGER IF EXISTS chat_chatmessage_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_chatmessage_fts_update",
+    "DROP TABLE IF EXISTS chat_chatmessage_fts",
+]
+
+# PostgreSQL - GIN index on same to_tsvector() expression search.py queries
+POSTGRES_CREATE = [
+    """CREATE INDEX chat_msg_search_idx ON chat_chatmessage
+        USING GIN (to_tsvector('english', message))""",
+]
+
+POSTGRES_DROP = [
+    "DROP INDEX IF EXISTS chat_msg_search_idx",
+]
+
+
+def has_fts5(connection):
+    """ Whether this SQLite build was compiled with FTS5 """
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return ('ENABLE_FTS5',) in cursor.fetchall()
+
+
+def run(statements, schema_editor):
+    """ Run raw statements with schema editor (inside migration) """
+    for sql in statements:
+        schema_editor.execute(sql, params=None)
+
+
+def create_search_index(apps, schema_editor):
+    """ Build full-text index for database in use (others use LIKE) """
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite' and has_fts5(connection):
+        run(SQLITE_CREATE, schema_editor)
+    elif connection.vendor == 'postgresql':
+        run(POSTGRES_CREATE, schema_editor)
+
+
+def drop_search_index(apps, schema_editor):
+    """ Undo create_search_index """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        run(SQLITE_DROP, schema_editor)
+    elif vendor == 'postgresql':
+        run(POSTGRES_DROP, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_chatmessage_room_id_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.2.12 on 2026-10-18 11:05
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def fill_counters(apps, schema_editor):
+    """ Count messages already in each room (one grouped query) """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    stats = (ChatMessage.objects.values('room_id').order_by()
+             .annotate(count=Count('id'), last_id=Max('id')))
+    stats = {row['last_id']: row for row in stats}
+    timestamps = ChatMessage.objects.filter(id__in=list(stats)).values_list(
+        'id', 'timestamp')
+    for last_id, timestamp in timestamps:
+        row = stats[last_id]
+        ChatRoom.objects.filter(pk=row['room_id']).update(
+            message_count=row['count'], last_message_id=last_id,
+            last_message_at=timestamp)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chatmessage_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_id',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
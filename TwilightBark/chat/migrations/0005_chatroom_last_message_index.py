@@ -0,0 +1,17 @@
+# Generated by Django 2.2.12 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatroom_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['last_message_at'], name='chat_room_last_message_idx'),
+        ),
+    ]
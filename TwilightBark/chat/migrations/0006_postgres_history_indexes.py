@@ -0,0 +1,53 @@
+# Indexes only PostgreSQL gets - SQLite keeps using (room, id) for everything
+
+from django.db import migrations
+
+
+# CONCURRENTLY so big message tables stay writable while indexes build
+# (needs migration outside a transaction - atomic = False below)
+POSTGRES_CREATE = [
+    # Time ranges within room - export_room --since/--until, retention
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_msg_room_time_idx
+        ON chat_chatmessage (room_id, timestamp)""",
+    # Time ranges over all rooms (admin month filter) - BRIN stays tiny
+    # since rows are inserted in time order
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_msg_time_brin_idx
+        ON chat_chatmessage USING BRIN (timestamp)""",
+    # Refresh planner stats so admin's row estimate is right straight away
+    "ANALYZE chat_chatmessage",
+]
+
+POSTGRES_DROP = [
+    "DROP INDEX CONCURRENTLY IF EXISTS chat_msg_room_time_idx",
+    "DROP INDEX CONCURRENTLY IF EXISTS chat_msg_time_brin_idx",
+]
+
+
+def run(statements, schema_editor):
+    """ Run raw statements on PostgreSQL only """
+    if schema_editor.connection.vendor == 'postgresql':
+        for sql in statements:
+            schema_editor.execute(sql, params=None)
+
+
+def create_indexes(apps, schema_editor):
+    """ Add history indexes (PostgreSQL) """
+    run(POSTGRES_CREATE, schema_editor)
+
+
+def drop_indexes(apps, schema_editor):
+    """ Undo create_indexes """
+    run(POSTGRES_DROP, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('chat', '0005_chatroom_last_message_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -1,14 +1,71 @@
 """ Define models for chat room system - room and messages """
 from django.conf import settings
 from django.db import models
+from django.db.models import Case, F, Q, Value, When
+
+
+# Number of messages sent per history page (initial backlog and load_older)
+MESSAGES_PER_PAGE = 5
+
+
+class RoomManager(models.Manager):
+    """ Room manager to keep per-room message counters up to date """
+
+    def record_messages(self, room_id, count, last_message):
+        """ Add count new messages (newest last_message) to room counters """
+        # Single UPDATE so concurrent writers never lose an increment - last
+        # message only moves forward if another writer already went past it
+        newer = (Q(last_message_id__isnull=True) |
+                 Q(last_message_id__lt=last_message.id))
+        return self.filter(pk=room_id).update(
+            message_count=F('message_count') + count,
+            last_message_id=Case(
+                When(newer, then=Value(last_message.id)),
+                default=F('last_message_id'),
+                output_field=models.PositiveIntegerField()),
+            last_message_at=Case(
+                When(newer, then=Value(last_message.timestamp)),
+                default=F('last_message_at'),
+                output_field=models.DateTimeField()))
+
+    def rebuild_counters(self, room_id):
+        """ Recount room's messages from scratch (repair after deletes) """
+        # Room row locked so writers wait until recount is saved
+        room = self.select_for_update().get(pk=room_id)
+        messages = ChatMessage.objects.filter(room_id=room_id)
+        last = messages.order_by('-id').values('id', 'timestamp').first()
+        room.message_count = messages.count()
+        room.last_message_id = last['id'] if last else None
+        room.last_message_at = last['timestamp'] if last else None
+        room.save(update_fields=['message_count', 'last_message_id',
+                                 'last_message_at'])
+        return room
 
 
 class ChatRoom(models.Model):
     """ Chat room model to hold Users and provide group for ChatMessages """
 
     name = models.CharField(max_length=100, unique=True, blank=False)
+    # Only kept up to date when CHAT_PRESENCE SNAPSHOT is on - live counts
+    # come from chat.presence
     users = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True,
                                    help_text='Users connected to chat room')
+    # Kept up to date on every message write (RoomManager.record_messages)
+    # so page counts and activity never count messages table
+    message_count = models.PositiveIntegerField(default=0, editable=False)
+    last_message_at = models.DateTimeField(null=True, blank=True,
+                                           editable=False)
+    last_message_id = models.PositiveIntegerField(null=True, blank=True,
+                                                  editable=False)
+
+    objects = RoomManager()
+
+    class Meta:
+        # Room directory falls back to most recently active rooms
+        indexes = [
+            models.Index(fields=['last_message_at'],
+                         name='chat_room_last_message_idx'),
+        ]
 
     def __str__(self):
         """ String representation of chat room """
@@ -16,20 +73,16 @@ class ChatRoom(models.Model):
 
     def connect_user(self, user):
         """ When user connects to socket, add to chat room """
-        is_user_added = False
-        if user not in self.users.all():
-            self.users.add(user)
-            is_user_added = True
-        if user in self.users.all():
-            is_user_added = True
-        return is_user_added
+        # add() skips users already in room so no need to load user list
+        self.users.add(user)
+        return True
 
     def disconnect_user(self, user):
         """ When user disconnects from socket, remove from chat room """
-        is_user_removed = False
-        if user in self.users.all():
+        # Check just this user's row rather than loading every user
+        is_user_removed = self.users.filter(pk=user.pk).exists()
+        if is_user_removed:
             self.users.remove(user)
-            is_user_removed = True
         return is_user_removed
 
     # @property
@@ -41,11 +94,29 @@ class ChatRoom(models.Model):
 class MessageManager(models.Manager):
     """ Message manager to return messages by room - link models """
 
-    def by_room(self, room):
+    def by_room(self, room, before=None):
         """ Get messages by room - ordered by latest first """
-        queryset = ChatMessage.objects.filter(room=room).order_by('-timestamp')
+        # Ids are assigned in insert order so ordering by id matches timestamp
+        # order and can use the (room, id) index instead of sorting
+        queryset = ChatMessage.objects.filter(room=room).order_by('-id')
+        if before is not None:
+            # Keyset pagination - only messages older than cursor message id
+            queryset = queryset.filter(id__lt=before)
         return queryset
 
+    def page_before(self, room, before=None, count=MESSAGES_PER_PAGE,
+                    fields=()):
+        """ Get one page of messages older than before (latest first) """
+        queryset = self.by_room(room, before)
+        if fields:
+            # Plain dict rows - related fields (user__x) joined in same query
+            queryset = queryset.values(*fields)
+        # Fetch one extra row to find out if there are older messages left
+        # without counting whole room
+        messages = list(queryset[:count + 1])
+        has_more = len(messages) > count
+        return messages[:count], has_more
+
 
 class ChatMessage(models.Model):
     """ Chat message model for message created by User in ChatRoom """
@@ -58,6 +129,12 @@ class ChatMessage(models.Model):
     # Create interface between ChatMessage and ChatRoom
     objects = MessageManager()
 
+    class Meta:
+        # History is always read per room newest first, page by page
+        indexes = [
+            models.Index(fields=['room', 'id'], name='chat_msg_room_id_idx'),
+        ]
+
     def __str__(self):
         """ String representation of chat message (content of message) """
         return self.message
@@ -0,0 +1,148 @@
+""" Track who is connected to each room without scanning ChatRoom.users """
+import asyncio
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from functools import lru_cache
+from .utils import load_backend
+
+
+class LocalPresence:
+    """ Per-worker counters - room -> user -> number of open tabs """
+
+    def __init__(self):
+        self.rooms = {}
+
+    async def join(self, room_id, user_id):
+        """ Add tab for user - return (first tab for user, users in room) """
+        users = self.rooms.setdefault(room_id, {})
+        users[user_id] = users.get(user_id, 0) + 1
+        return users[user_id] == 1, len(users)
+
+    async def leave(self, room_id, user_id):
+        """ Remove tab for user - return (last tab for user, users in room) """
+        users = self.rooms.get(room_id, {})
+        tabs = users.pop(user_id, 0) - 1
+        if tabs > 0:
+            users[user_id] = tabs
+        elif not users:
+            # Drop empty rooms so dict doesn't grow with every room ever used
+            self.rooms.pop(room_id, None)
+        return tabs == 0, len(users)
+
+    async def count(self, room_id):
+        """ Number of distinct users connected to room """
+        return len(self.rooms.get(room_id, ()))
+
+
+class RedisPresence:
+    """ Shared counters in one Redis hash per room - user id -> open tabs """
+
+    JOIN_SCRIPT = """
+        local tabs = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+        return {tabs, redis.call('HLEN', KEYS[1])}
+    """
+
+    LEAVE_SCRIPT = """
+        local tabs = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+        if tabs <= 0 then
+            redis.call('HDEL', KEYS[1], ARGV[1])
+        end
+        return {tabs, redis.call('HLEN', KEYS[1])}
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, expiry=86400,
+                 prefix='presence'):
+        """ expiry clears counts left behind by a worker that crashed """
+        import redis
+        self.redis = redis.Redis(host=host, port=port, db=db)
+        self.expiry = expiry
+        self.prefix = prefix
+        self.join_script = self.redis.register_script(self.JOIN_SCRIPT)
+        self.leave_script = self.redis.register_script(self.LEAVE_SCRIPT)
+
+    def key(self, room_id):
+        """ Redis hash holding room's connected users """
+        return f"{self.prefix}:{room_id}"
+
+    async def join(self, room_id, user_id):
+        """ Add tab for user - return (first tab for user, users in room) """
+        tabs, count = await sync_to_async(
+            self.join_script, thread_sensitive=False)(
+                keys=[self.key(room_id)], args=[user_id, self.expiry])
+        return tabs == 1, count
+
+    async def leave(self, room_id, user_id):
+        """ Remove tab for user - return (last tab for user, users in room) """
+        tabs, count = await sync_to_async(
+            self.leave_script, thread_sensitive=False)(
+                keys=[self.key(room_id)], args=[user_id])
+        return tabs == 0, count
+
+    async def count(self, room_id):
+        """ Number of distinct users connected to room """
+        return await sync_to_async(self.redis.hlen, thread_sensitive=False)(
+            self.key(room_id))
+
+
+class PresenceAggregator:
+    """ Batch joins/leaves per room into one presence_delta group message """
+
+    def __init__(self, window=0.25, threshold=20):
+        """ threshold is most names listed before only counts are sent """
+        self.window = window
+        self.threshold = threshold
+        # room group name -> usernames joined/left since last broadcast
+        self.rooms = {}
+
+    def add(self, channel_layer, group_name, room_id, joined="", left=""):
+        """ Record join/leave - first event in window schedules broadcast """
+        pending = self.rooms.get(group_name)
+        if pending is None:
+            pending = self.rooms[group_name] = {"joined": {}, "left": {}}
+            asyncio.ensure_future(
+                self.broadcast_later(channel_layer, group_name, room_id))
+        # dicts are used as ordered sets of usernames
+        if joined:
+            # Quick reconnect (left then joined again) cancels out
+            if pending["left"].pop(joined, None) is None:
+                pending["joined"][joined] = True
+        if left:
+            if pending["joined"].pop(left, None) is None:
+                pending["left"][left] = True
+
+    async def broadcast_later(self, channel_layer, group_name, room_id):
+        """ After window, send everything collected for room in one frame """
+        await asyncio.sleep(self.window)
+        pending = self.rooms.pop(group_name)
+        joined, left = list(pending["joined"]), list(pending["left"])
+        event = {
+            "type": "presence_delta",
+            "count": await get_presence().count(room_id),
+            "joinedCount": len(joined),
+            "leftCount": len(left),
+        }
+        if len(joined) + len(left) <= self.threshold:
+            # Small changes list names - big waves only send counts
+            event["joined"] = joined
+            event["left"] = left
+        await channel_layer.group_send(group_name, event)
+
+
+@lru_cache(maxsize=None)
+def get_aggregator():
+    """ Return process-wide aggregator configured by CHAT_PRESENCE """
+    config = getattr(settings, 'CHAT_PRESENCE', {})
+    return PresenceAggregator(config.get('DELTA_WINDOW', 0.25),
+                              config.get('DELTA_THRESHOLD', 20))
+
+
+@lru_cache(maxsize=None)
+def get_presence():
+    """ Return process-wide presence backend defined by CHAT_PRESENCE """
+    return load_backend('CHAT_PRESENCE', 'chat.presence.LocalPresence')
+
+
+def snapshot_enabled():
+    """ Whether to also keep ChatRoom.users in sync (first/last tab only) """
+    return getattr(settings, 'CHAT_PRESENCE', {}).get('SNAPSHOT', False)
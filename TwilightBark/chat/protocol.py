@@ -0,0 +1,96 @@
+""" Websocket frame encodings - JSON by default, compact msgpack if asked """
+import json
+
+try:
+    import msgpack
+except ImportError:
+    # Optional - without it every client gets JSON
+    msgpack = None
+
+
+# Subprotocols client can ask for in Sec-WebSocket-Protocol header
+JSON_PROTOCOL = 'twilightbark.json'
+MSGPACK_PROTOCOL = 'twilightbark.msgpack'
+
+# Short codes for field names in compact frames (static/js/compact.js has
+# the same table to expand them again)
+FIELD_CODES = {
+    'type': 'T',
+    'msg_type': 't',
+    'message': 'm',
+    'messages': 'M',
+    'user': 'u',
+    'timestamp': 's',
+    'pic': 'p',
+    'id': 'i',
+    'pageNum': 'n',
+    'before': 'b',
+    'hasMore': 'h',
+    'count': 'c',
+    'joined': 'j',
+    'left': 'l',
+    'joinedCount': 'J',
+    'leftCount': 'L',
+    'error': 'e',
+    'query': 'q',
+    'page': 'g',
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+
+def choose_protocol(subprotocols):
+    """ Pick subprotocol to accept from ones client offered (or None) """
+    if msgpack is not None and MSGPACK_PROTOCOL in subprotocols:
+        return MSGPACK_PROTOCOL
+    if JSON_PROTOCOL in subprotocols:
+        return JSON_PROTOCOL
+    # Old clients don't offer any - plain JSON, no subprotocol
+    return None
+
+
+def compact(frame):
+    """ Shorten field names - message lists share one table of pic urls """
+    short = {}
+    for key, value in frame.items():
+        if key == 'messages':
+            # Pic url -> position in table (dicts keep insertion order)
+            pics = {}
+            rows = []
+            for message in value:
+                row = {FIELD_CODES.get(k, k): v for k, v in message.items()}
+                if 'p' in row:
+                    # Pic url sent once per frame, rows hold its index
+                    row['p'] = pics.setdefault(row['p'], len(pics))
+                rows.append(row)
+            short['M'] = rows
+            short['P'] = list(pics)
+        else:
+            short[FIELD_CODES.get(key, key)] = value
+    return short
+
+
+def expand(frame):
+    """ Undo compact() field codes for frame sent by a compact client """
+    return {FIELD_NAMES.get(key, key): value for key, value in frame.items()}
+
+
+def encode_frame(frame, protocol):
+    """ Return (text, bytes) to send - exactly one of them is None """
+    if protocol == MSGPACK_PROTOCOL:
+        return None, msgpack.packb(compact(frame), use_bin_type=True)
+    return json.dumps(frame), None
+
+
+def decode_frame(text_data, bytes_data):
+    """ Parse frame from client - text is JSON, bytes are compact msgpack """
+    # Bad frames raise ValueError (json and msgpack errors are ValueErrors)
+    if bytes_data is not None:
+        if msgpack is None:
+            # msgpack was never accepted in handshake, so nothing can read it
+            raise ValueError('Binary frames need msgpack installed')
+        frame = msgpack.unpackb(bytes_data, raw=False)
+    else:
+        frame = json.loads(text_data)
+    if not isinstance(frame, dict):
+        raise ValueError('Frame must be an object')
+    return expand(frame) if bytes_data is not None else frame
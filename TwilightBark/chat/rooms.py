@@ -0,0 +1,95 @@
+""" Process-wide cache of ChatRoom objects so rooms are looked up once """
+import asyncio
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from functools import lru_cache
+from .db import database_sync_to_async
+from .models import ChatRoom
+
+
+class RoomRegistry:
+    """ LRU cache of room name -> ChatRoom with expiry and get-or-create """
+
+    def __init__(self, size=1000, ttl=300):
+        """ ttl is seconds before a cached room is read from db again """
+        self.size = size
+        self.ttl = ttl
+        # name -> (room, time it expires) - most recently used last
+        self.rooms = OrderedDict()
+        # name -> lock so concurrent connects to new room share one lookup
+        self.locks = {}
+        # room id -> message count - read with room, then kept up to date
+        # with messages this worker saves (others' show up on next reload)
+        self.counts = {}
+
+    def cached(self, name):
+        """ Return cached room if it hasn't expired, else None """
+        entry = self.rooms.get(name)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        self.rooms.move_to_end(name)
+        return entry[0]
+
+    async def get_or_create(self, name):
+        """ Return ChatRoom for name, creating it in db if it doesn't exist """
+        room = self.cached(name)
+        if room is not None:
+            return room
+        lock = self.locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            # Another connection may have loaded room while we waited
+            room = self.cached(name)
+            if room is None:
+                room = await get_or_create_room(name)
+                self.rooms[name] = (room, time.monotonic() + self.ttl)
+                self.counts[room.id] = room.message_count
+                self.rooms.move_to_end(name)
+                if len(self.rooms) > self.size:
+                    # Drop least recently used room
+                    dropped = self.rooms.popitem(last=False)[1][0]
+                    self.counts.pop(dropped.id, None)
+        if not lock.locked():
+            self.locks.pop(name, None)
+        return room
+
+    def invalidate(self, room):
+        """ Forget room (renamed or deleted) - matched by id, not name """
+        for name, (cached_room, expires) in list(self.rooms.items()):
+            if cached_room.id == room.id:
+                del self.rooms[name]
+        self.counts.pop(room.id, None)
+
+    def count_messages(self, room_id, count=1):
+        """ Add messages this worker saved to room's cached count """
+        if room_id in self.counts:
+            self.counts[room_id] += count
+
+    def message_count(self, room):
+        """ Room's message count without a db query """
+        return self.counts.get(room.id, room.message_count)
+
+
+@database_sync_to_async
+def get_or_create_room(name):
+    """ Get ChatRoom by name or create it - safe when two clients race """
+    # get_or_create retries the get if another create wins the unique name
+    return ChatRoom.objects.get_or_create(name=name)[0]
+
+
+@lru_cache(maxsize=None)
+def get_registry():
+    """ Return process-wide room registry configured by CHAT_ROOM_CACHE """
+    config = getattr(settings, 'CHAT_ROOM_CACHE', {})
+    return RoomRegistry(config.get('SIZE', 1000), config.get('TTL', 300))
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def invalidate_room(sender, instance, **kwargs):
+    """ Drop room from this process's registry when it changes in db """
+    if not kwargs.get('created'):
+        # New rooms can't be cached yet
+        get_registry().invalidate(instance)
@@ -0,0 +1,105 @@
+""" Ranked full-text search over chat messages (index built by migration) """
+import re
+from django.db import connection
+from functools import lru_cache
+from .models import ChatMessage
+from .utils import encode_history, with_display_time, HISTORY_FIELDS
+
+
+# Results sent per search page (websocket and http)
+SEARCH_PER_PAGE = 20
+# Longer queries are cut off - every word is another index lookup
+MAX_QUERY_LENGTH = 200
+
+# Words in query - punctuation is dropped so users can't write FTS5 syntax
+WORDS = re.compile(r'\w+')
+
+# Best matches first (bm25 scores are lower for better matches) - newest
+# first between equal scores
+SQLITE_SEARCH = """
+    SELECT m.id FROM chat_chatmessage_fts
+    JOIN chat_chatmessage m ON m.id = chat_chatmessage_fts.rowid
+    WHERE chat_chatmessage_fts MATCH %s AND m.room_id = %s
+    ORDER BY bm25(chat_chatmessage_fts), m.id DESC
+    LIMIT %s OFFSET %s
+"""
+
+POSTGRES_SEARCH = """
+    SELECT id FROM chat_chatmessage
+    WHERE room_id = %s
+        AND to_tsvector('english', message) @@ plainto_tsquery('english', %s)
+    ORDER BY ts_rank(to_tsvector('english', message),
+                     plainto_tsquery('english', %s)) DESC, id DESC
+    LIMIT %s OFFSET %s
+"""
+
+
+@lru_cache(maxsize=None)
+def search_backend():
+    """ 'fts5', 'postgres' or 'like' (no full-text index - slow scan) """
+    if connection.vendor == 'postgresql':
+        return 'postgres'
+    if (connection.vendor == 'sqlite' and 'chat_chatmessage_fts' in
+            connection.introspection.table_names()):
+        return 'fts5'
+    return 'like'
+
+
+def fts5_query(query):
+    """ Quote every word so FTS5 matches messages containing all of them """
+    return ' '.join(f'"{word}"' for word in WORDS.findall(query))
+
+
+def search_ids(room, query, count, offset=0):
+    """ Ids of messages in room matching query, best match first """
+    backend = search_backend()
+    if backend == 'fts5':
+        sql, params = SQLITE_SEARCH, [fts5_query(query), room.id]
+    elif backend == 'postgres':
+        sql, params = POSTGRES_SEARCH, [room.id, query, query]
+    else:
+        return list(ChatMessage.objects.by_room(room)
+                    .filter(message__icontains=query)
+                    .values_list('id', flat=True)[offset:offset + count])
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [count, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_room(room, query, page=1, per_page=SEARCH_PER_PAGE):
+    """ Return (messages, has_more) for one page of ranked results """
+    query = query[:MAX_QUERY_LENGTH]
+    if not WORDS.search(query):
+        return [], False
+    offset = (page - 1) * per_page
+    # One extra id tells if there is another page without counting
+    ids = search_ids(room, query, per_page + 1, offset)
+    has_more = len(ids) > per_page
+    ids = ids[:per_page]
+    rows = {row['id']: row for row in ChatMessage.objects
+            .filter(id__in=ids).values(*HISTORY_FIELDS)}
+    # Keep rank order from search query
+    messages = encode_history([rows[id] for id in ids if id in rows])
+    return with_display_time(messages), has_more
+
+
+def filter_matching(queryset, query):
+    """ Narrow ChatMessage queryset to full-text matches (for admin) """
+    # extra() rather than id__in=RawSQL - SQLite reads "IN ((SELECT ..))"
+    # as a single value, not a list
+    backend = search_backend()
+    if backend == 'fts5':
+        words = fts5_query(query)
+        if not words:
+            return queryset.none()
+        return queryset.extra(
+            where=["chat_chatmessage.id IN (SELECT rowid FROM "
+                   "chat_chatmessage_fts "
+                   "WHERE chat_chatmessage_fts MATCH %s)"],
+            params=[words])
+    if backend == 'postgres':
+        return queryset.extra(
+            where=["to_tsvector('english', chat_chatmessage.message) @@ "
+                   "plainto_tsquery('english', %s)"],
+            params=[query])
+    return queryset.filter(message__icontains=query)
@@ -0,0 +1,336 @@
+""" Tests for chat """
+import asyncio
+import redis
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from channels_redis.core import RedisChannelLayer
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.test import (override_settings, SimpleTestCase, TestCase,
+                         TransactionTestCase)
+from unittest import mock
+from user.cards import get_user_card, get_user_cards, invalidate_user_card
+from user.models import User
+from .backlog import LocalBacklog
+from .consumers import ChatConsumer, get_room_chat_messages_sync
+from .layers import HybridChannelLayer
+from .limits import counters, get_limiter
+from .models import ChatMessage, ChatRoom
+from .utils import serialize_message
+
+
+# Redis layer tests run against - skipped if nothing is listening there
+TEST_REDIS = ('localhost', 6379)
+
+
+class HistoryQueryTests(TestCase):
+    """ A page of history costs the same queries whatever its size """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.room = ChatRoom.objects.create(name='history')
+        users = [User.objects.create_user(email=f'user{i}@test.com',
+                                          username=f'user{i}',
+                                          password='password')
+                 for i in range(10)]
+        ChatMessage.objects.bulk_create([
+            ChatMessage(room=cls.room, user=users[i % len(users)],
+                        message=f'message {i}')
+            for i in range(120)])
+
+    def setUp(self):
+        # Cached user cards from another test would save the user query
+        cache.clear()
+
+    def test_newest_page(self):
+        """ Messages query plus one user query for every author on page """
+        for count in (5, 50):
+            cache.clear()
+            with self.assertNumQueries(2):
+                messages, has_more = get_room_chat_messages_sync(
+                    self.room, count=count)
+            self.assertEqual(len(messages), count)
+            self.assertTrue(has_more)
+
+    def test_older_page(self):
+        """ Paging back with a cursor doesn't add queries """
+        newest, _ = get_room_chat_messages_sync(self.room, count=5)
+        for count in (5, 50):
+            cache.clear()
+            with self.assertNumQueries(2):
+                messages, _ = get_room_chat_messages_sync(
+                    self.room, newest[-1]['id'], count)
+            self.assertEqual(len(messages), count)
+            self.assertLess(messages[0]['id'], newest[-1]['id'])
+
+    def test_cached_users(self):
+        """ Authors already cached - only the messages query is left """
+        get_room_chat_messages_sync(self.room, count=50)
+        for count in (5, 50):
+            with self.assertNumQueries(1):
+                get_room_chat_messages_sync(self.room, count=count)
+
+    def test_last_page(self):
+        """ Whole room on one page - archive check doesn't query db """
+        with self.assertNumQueries(2):
+            messages, has_more = get_room_chat_messages_sync(self.room,
+                                                             count=200)
+        self.assertEqual(len(messages), 120)
+        self.assertFalse(has_more)
+
+
+class LocalBacklogTests(SimpleTestCase):
+    """ Worker's backlog keeps only its most recently used rooms """
+
+    def test_coldest_room_dropped(self):
+        """ Room not read or written for longest goes first """
+        async def test():
+            backlog = LocalBacklog(size=5, max_rooms=2)
+            message = {'id': 1, 'message': 'hello'}
+            await backlog.fill(1, [message], False)
+            await backlog.fill(2, [message], False)
+            # Reading room 1 makes room 2 the coldest
+            await backlog.recent(1, 5)
+            await backlog.push(3, dict(message, id=2))
+            self.assertEqual(list(backlog.rooms), [1, 3])
+            self.assertIsNone(await backlog.recent(2, 5))
+            self.assertEqual(await backlog.recent(1, 5), ([message], False))
+        async_to_sync(test)()
+
+
+class UserCardTests(TestCase):
+    """ Cards are read from db by id, never from whoever asks for them """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_stale_user_after_invalidate(self):
+        """ Socket's old user object doesn't cache its old name again """
+        user = User.objects.create_user(email='card@test.com',
+                                        username='before',
+                                        password='password')
+        room = ChatRoom.objects.create(name='cards')
+        get_user_card(user.id)
+        User.objects.filter(pk=user.pk).update(username='after')
+        invalidate_user_card(user.id)
+        # user still has old name, like scope user of an open socket
+        message = ChatMessage.objects.create(room=room, user=user,
+                                             message='hello')
+        self.assertEqual(serialize_message(message)['user'], 'after')
+        self.assertEqual(get_user_cards([user.id])[user.id]['user'], 'after')
+
+
+class ReceiveTests(TransactionTestCase):
+    """ Frames consumer can't act on get an error frame, never a crash """
+
+    def test_bad_frames(self):
+        """ Missing message or unknown command - socket keeps working """
+        user = User.objects.create_user(email='frames@test.com',
+                                        username='frames',
+                                        password='password')
+        layers = {'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+        with override_settings(CHANNEL_LAYERS=layers):
+            async_to_sync(self.send_bad_frames)(user)
+
+    async def send_bad_frames(self, user):
+        """ Send bad frames then a good one on one socket """
+        socket = WebsocketCommunicator(ChatConsumer.as_asgi(),
+                                       '/ws/chat/frames/')
+        socket.scope['url_route'] = {'kwargs': {'room_name': 'frames'}}
+        socket.scope['user'] = user
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        await socket.receive_json_from()
+        get_limiter.cache_clear()
+        for frame, error in (({'foo': 1}, 'Invalid message'),
+                             ({'message': 5}, 'Invalid message'),
+                             ({'command': 'lod_older'}, 'Unknown command')):
+            await socket.send_json_to(frame)
+            self.assertEqual(await socket.receive_json_from(),
+                             {'msg_type': 'error', 'error': error})
+        # Bad frames didn't use up sender's tokens
+        self.assertEqual(get_limiter().buckets, {})
+        await socket.send_json_to({'message': 'hello'})
+        while True:
+            frame = await socket.receive_json_from()
+            if frame.get('msg_type') == 'message':
+                break
+        self.assertEqual(frame['message'], 'hello')
+        await socket.disconnect()
+
+
+class SlowReaderTests(TransactionTestCase):
+    """ Socket whose client stopped reading can't hold up its room """
+
+    # Messages the layer holds for one consumer
+    CAPACITY = 5
+
+    def test_blocked_send(self):
+        """ Group sends don't wait for it and its backlog stops at capacity """
+        layers = {'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {'capacity': self.CAPACITY},
+        }}
+        with override_settings(CHANNEL_LAYERS=layers):
+            async_to_sync(self.run_blocked_reader)()
+
+    async def run_blocked_reader(self):
+        """ Connect socket whose every send blocks until it is unblocked """
+        inbox = asyncio.Queue()
+        stuck = asyncio.Event()
+        unblocked = asyncio.Event()
+        frames = []
+
+        async def send(message):
+            if message['type'] == 'websocket.send':
+                # Server waiting on client (daphne never does, others may)
+                stuck.set()
+                await unblocked.wait()
+                frames.append(message.get('text'))
+
+        scope = {'type': 'websocket', 'path': '/ws/chat/slow/',
+                 'url_route': {'kwargs': {'room_name': 'slow'}},
+                 'user': AnonymousUser(), 'subprotocols': []}
+        app = asyncio.ensure_future(
+            ChatConsumer.as_asgi()(scope, inbox.get, send))
+        await inbox.put({'type': 'websocket.connect'})
+        await asyncio.wait_for(stuck.wait(), 5)
+        layer = get_channel_layer()
+        for i in range(self.CAPACITY * 4):
+            # Returns at once though consumer is stuck on first frame
+            await asyncio.wait_for(layer.group_send('chat_slow', {
+                'type': 'create_chat_message', 'text': f'frame {i}',
+                'bytes': None}), 1)
+        unblocked.set()
+        for _ in range(100):
+            # Let consumer catch up on what layer kept for it
+            await asyncio.sleep(0.02)
+            sent = [text for text in frames if text.startswith('frame')]
+            if len(sent) > self.CAPACITY:
+                break
+        await inbox.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(app, 5)
+        sent = [text for text in frames if text.startswith('frame')]
+        # Dispatch loop had already taken one more off layer while stuck
+        self.assertEqual(sent,
+                         [f'frame {i}' for i in range(self.CAPACITY + 1)])
+
+
+class HybridChannelLayerTests(SimpleTestCase):
+    """ Two layers on one Redis act as two daphne workers """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        try:
+            redis.Redis(*TEST_REDIS, socket_connect_timeout=1).ping()
+        except redis.ConnectionError:
+            raise cls.skipTest(cls, f'No Redis at {TEST_REDIS}')
+
+    def setUp(self):
+        # Wraps real group_send so tests can see when Redis is used
+        patcher = mock.patch.object(RedisChannelLayer, 'group_send',
+                                    autospec=True,
+                                    side_effect=RedisChannelLayer.group_send)
+        self.redis_group_send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_workers(self, test, **config):
+        """ Run test(worker, other worker) on one event loop """
+        async def run():
+            # Own key prefix so flush only deletes keys made here
+            workers = [HybridChannelLayer(hosts=[TEST_REDIS],
+                                          prefix='chat-tests', **config)
+                       for _ in range(2)]
+            try:
+                await test(*workers)
+            finally:
+                await workers[0].flush()
+                for worker in workers:
+                    await worker.close_pools()
+        async_to_sync(run)()
+
+    async def receive(self, layer, channel):
+        """ Next message for channel - None if nothing comes """
+        try:
+            return await asyncio.wait_for(layer.receive(channel), 0.5)
+        except asyncio.TimeoutError:
+            return None
+
+    def test_local_members(self):
+        """ Group with every member on this worker never touches Redis """
+        async def test(worker, other):
+            first = await worker.new_channel()
+            second = await worker.new_channel()
+            await worker.group_add('room', first)
+            await worker.group_add('room', second)
+            self.redis_group_send.reset_mock()
+            await worker.group_send('room', {'type': 'chat', 'text': 'hi'})
+            self.redis_group_send.assert_not_called()
+            for channel in (first, second):
+                message = await self.receive(worker, channel)
+                self.assertEqual(message['text'], 'hi')
+        self.run_workers(test)
+
+    def test_remote_members(self):
+        """ Member joining on another worker gets messages through Redis """
+        async def test(worker, other):
+            local = await worker.new_channel()
+            remote = await other.new_channel()
+            await worker.group_add('room', local)
+            # Consumer is always waiting on receive - it reads member notice
+            received = asyncio.ensure_future(self.receive(worker, local))
+            await other.group_add('room', remote)
+            for _ in range(100):
+                if worker.remote_groups.get('room'):
+                    break
+                await asyncio.sleep(0.01)
+            self.redis_group_send.reset_mock()
+            await worker.group_send('room', {'type': 'chat', 'text': 'hi'})
+            self.redis_group_send.assert_called_once()
+            self.assertEqual((await received)['text'], 'hi')
+            message = await self.receive(other, remote)
+            self.assertEqual(message['text'], 'hi')
+            # One copy each - local member isn't sent another through Redis
+            self.assertIsNone(await self.receive(worker, local))
+        self.run_workers(test)
+
+    def test_discard(self):
+        """ Members who left get nothing - Redis skipped again once empty """
+        async def test(worker, other):
+            local = await worker.new_channel()
+            gone = await worker.new_channel()
+            remote = await other.new_channel()
+            await worker.group_add('room', local)
+            await worker.group_add('room', gone)
+            await other.group_add('room', remote)
+            await worker.group_discard('room', gone)
+            await other.group_discard('room', remote)
+            # Remote member wasn't seen leaving - first send checks Redis
+            await worker.group_send('room', {'type': 'chat', 'text': 'one'})
+            self.redis_group_send.reset_mock()
+            await worker.group_send('room', {'type': 'chat', 'text': 'two'})
+            self.redis_group_send.assert_not_called()
+            for text in ('one', 'two'):
+                message = await self.receive(worker, local)
+                self.assertEqual(message['text'], text)
+            self.assertIsNone(await self.receive(worker, gone))
+            self.assertIsNone(await self.receive(other, remote))
+        self.run_workers(test)
+
+    def test_full_channel(self):
+        """ Local member that stopped reading misses messages past capacity """
+        async def test(worker, other):
+            stuck = await worker.new_channel()
+            await worker.group_add('room', stuck)
+            counters.clear()
+            for i in range(5):
+                await worker.group_send('room', {'type': 'chat', 'text': i})
+            self.assertEqual(counters['frames_dropped'], 2)
+            for i in range(3):
+                message = await self.receive(worker, stuck)
+                self.assertEqual(message['text'], i)
+            self.assertIsNone(await self.receive(worker, stuck))
+        self.run_workers(test, capacity=3)
@@ -1,11 +1,14 @@
 """ Define url patterns for chat """
 from django.urls import path
-from .views import room
+from .views import directory, room, search
 
 
 # Set app_name connected to root directory's namespace
 app_name = 'chat'
 
 urlpatterns = [
+    # Room directory for landing page - empty path can't clash with a room
+    path('', directory, name='directory'),
     path('<room_name>/', room, name='room'),
+    path('<room_name>/search/', search, name='search'),
 ]
@@ -1,7 +1,25 @@
 """ Helper functions for chat """
 from datetime import datetime
-from django.contrib.humanize.templatetags.humanize import naturalday
-from django.core.serializers.python import Serializer
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+from user.cards import cached_user_card, get_user_card, get_user_cards
+from .db import database_sync_to_async
+
+
+def load_backend(setting_name, default_backend):
+    """ Build backend from settings dict shaped like CHANNEL_LAYERS """
+    config = getattr(settings, setting_name, {})
+    backend = import_string(config.get('BACKEND', default_backend))
+    return backend(**config.get('CONFIG', {}))
+
+
+# Rendered times keyed by minute - only valid for the day they were made on
+# since "today" turns into "yesterday" at midnight
+TIME_CACHE = {}
+TIME_CACHE_DAY = None
+TIME_CACHE_SIZE = 10000
 
 
 def calculate_time(timestamp):
@@ -11,33 +29,95 @@ def calculate_time(timestamp):
     2. Other days:
         - EX: 12/28/2020 at 7:31 PM
     """
-    ts = ""
+    global TIME_CACHE_DAY
+    # db stores UTC - compare days in site time zone (TIME_ZONE setting)
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    timestamp = timezone.localtime(timestamp)
+    today = timezone.localdate()
+    if today != TIME_CACHE_DAY or len(TIME_CACHE) > TIME_CACHE_SIZE:
+        # Day rolled over (or cache is full) - every cached string is stale
+        TIME_CACHE.clear()
+        TIME_CACHE_DAY = today
+    minute = timestamp.replace(second=0, microsecond=0)
+    ts = TIME_CACHE.get(minute)
+    if ts is None:
+        ts = TIME_CACHE[minute] = render_time(timestamp, today)
+    return ts
+
+
+def render_time(timestamp, today):
+    """ Format local timestamp relative to today (see calculate_time) """
+    # Get time - EX: 1:01 PM
+    str_time = datetime.strftime(timestamp, "%I:%M %p")
+    str_time = str_time.strip("0")
     # Today or yesterday
-    day = naturalday(timestamp)
-    if (day == "today") or (day == "yesterday"):
-        # Get time - EX: 1:01 PM
-        str_time = datetime.strftime(timestamp, "%I:%M %p")
-        str_time = str_time.strip("0")
+    days_ago = (today - timestamp.date()).days
+    if days_ago in (0, 1):
         # Create timestamp including day and time
-        ts = f"{day} at {str_time}"
-    # Other days - not sure if time AM/PM working
-    else:
-        str_time = datetime.strftime(timestamp, "%I:%M %p")
-        str_time = str_time.strip("0")
-        str_date = datetime.strftime(timestamp, "%m/%d/%Y")
-        ts = f"{str_date} at {str_time}"
-    return str(ts)
-
-
-class PayloadSerializer(Serializer):
-    """ Very literal serializing of queryset obj to correct format """
-
-    def get_dump_object(self, qs=None):
-        """ Modify default method to create serialized queryset object """
-        obj = {}
-        obj.update({'message': str(qs.message)})
-        obj.update({'user': str(qs.user.username)})
-        obj.update({'timestamp': calculate_time(qs.timestamp)})
-        obj.update({'pic': str(qs.user.profile_pic.url)})
-        obj.update({'id': str(qs.id)})
-        return obj
+        day = "today" if days_ago == 0 else "yesterday"
+        return f"{day} at {str_time}"
+    # Other days
+    str_date = datetime.strftime(timestamp, "%m/%d/%Y")
+    return f"{str_date} at {str_time}"
+
+
+def format_timestamp(timestamp):
+    """ Timestamp as sent to frontend - text or epoch ms per settings """
+    if getattr(settings, 'CHAT_TIMESTAMP_FORMAT', 'text') == 'epoch':
+        # Frontend formats time itself (in viewer's own time zone)
+        return int(timestamp.timestamp() * 1000)
+    return calculate_time(timestamp)
+
+
+async def load_user_card(user_id):
+    """ User card from cache, or from db on db thread on a miss """
+    card = cached_user_card(user_id)
+    if card is None:
+        card = await database_sync_to_async(get_user_card)(user_id)
+    return card
+
+
+def serialize_message(message, card=None):
+    """ Turn ChatMessage into dict that can be cached and sent to frontend """
+    # Username and pic url come from user card (async code loads it first)
+    if card is None:
+        card = get_user_card(message.user_id)
+    obj = {}
+    obj.update({'message': str(message.message)})
+    obj.update({'user': card['user']})
+    # Raw timestamp - formatted with format_timestamp right before sending
+    obj.update({'timestamp': message.timestamp.isoformat()})
+    obj.update({'pic': card['pic']})
+    obj.update({'id': message.id})
+    return obj
+
+
+def with_display_time(messages):
+    """ Copy serialized messages with timestamp formatted for frontend """
+    displayed = []
+    for message in messages:
+        timestamp = parse_datetime(message['timestamp'])
+        displayed.append(dict(message, timestamp=format_timestamp(timestamp)))
+    return displayed
+
+
+# Columns read for history - user details come from cached user cards
+HISTORY_FIELDS = ('id', 'message', 'timestamp', 'user_id')
+
+
+def encode_history(rows):
+    """ Turn ChatMessage values() rows into same dicts as serialize_message """
+    # One cache lookup for every author on page (db only for cache misses)
+    cards = get_user_cards(row['user_id'] for row in rows)
+    messages = []
+    for row in rows:
+        card = cards.get(row['user_id'], {'user': '', 'pic': ''})
+        messages.append({
+            'message': row['message'],
+            'user': card['user'],
+            'timestamp': row['timestamp'].isoformat(),
+            'pic': card['pic'],
+            'id': row['id'],
+        })
+    return messages
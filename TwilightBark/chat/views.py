@@ -1,5 +1,14 @@
 """ Define views connecting url to html template """
-from django.shortcuts import render
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404, render
+from .directory import get_listing
+from .models import ChatRoom
+from .search import search_room
+
+
+def directory(request):
+    """ Busiest rooms right now as json (cached for a few seconds) """
+    return JsonResponse({'rooms': get_listing()})
 
 
 def room(request, room_name):
@@ -7,3 +16,21 @@ def room(request, room_name):
     return render(request, 'chat/room.html', {
         'room_name': room_name,
     })
+
+
+def search(request, room_name):
+    """ Ranked search of room's messages - ?q=words&page=number as json """
+    room = get_object_or_404(ChatRoom, name=room_name)
+    query = request.GET.get('q', '')
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid page'}, status=400)
+    messages, has_more = search_room(room, query, page)
+    return JsonResponse({
+        'query': query,
+        'page': page,
+        # Best match first
+        'messages': messages,
+        'hasMore': has_more,
+    })
@@ -0,0 +1,130 @@
+""" Optional write-behind queue that saves chat messages to db in batches """
+import asyncio
+import atexit
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from functools import lru_cache
+from .backlog import get_backlog
+from .db import database_sync_to_async
+from .models import ChatMessage, ChatRoom
+from .rooms import get_registry
+from .utils import load_user_card, serialize_message
+
+
+logger = logging.getLogger(__name__)
+
+
+def log_failed_batch(messages, error):
+    """ Default flush failure hook - log every message that couldn't save """
+    for message in messages:
+        logger.error("Dropped chat message for room %s from user %s: %r (%s)",
+                     message.room_id, message.user_id, message.message, error)
+
+
+class MessageWriter:
+    """ Queue messages in memory and bulk insert every few ms or N messages """
+
+    def __init__(self, batch_size=100, flush_interval=0.005, retries=3,
+                 on_failure='chat.writer.log_failed_batch'):
+        """ on_failure is dotted path of hook called with unsaved batch """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.on_failure = import_string(on_failure)
+        self.pending = []
+        self.flush_task = None
+        # Only one batch written at a time so ids follow submit order
+        self.lock = asyncio.Lock()
+        # Save whatever is still queued when process shuts down
+        atexit.register(self.flush_sync)
+
+    def submit(self, room, user, message):
+        """ Queue new unsaved ChatMessage - returns before it hits the db """
+        # Its id stays None until its batch is saved - anything broadcast
+        # from it now can't be used as a history cursor
+        chat_message = ChatMessage(room=room, user=user, message=message,
+                                   timestamp=timezone.now())
+        self.pending.append(chat_message)
+        if len(self.pending) >= self.batch_size:
+            # Full batch - write now rather than waiting for timer
+            asyncio.ensure_future(self.flush())
+        elif self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+        return chat_message
+
+    async def flush_later(self):
+        """ Wait flush_interval so messages arriving meanwhile share batch """
+        await asyncio.sleep(self.flush_interval)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """ Save all queued messages in one transaction """
+        async with self.lock:
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+            for attempt in range(self.retries + 1):
+                try:
+                    await save_batch(batch)
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        # Out of retries - hand batch to durability hook
+                        self.on_failure(batch, e)
+                        return
+                    # Back off a little before trying again (db locked etc)
+                    await asyncio.sleep(self.flush_interval * 2 ** attempt)
+        backlog = get_backlog()
+        registry = get_registry()
+        for chat_message in batch:
+            registry.count_messages(chat_message.room_id)
+            # Only saved messages have ids, so backlog is filled after flush
+            card = await load_user_card(chat_message.user_id)
+            await backlog.push(chat_message.room_id,
+                               serialize_message(chat_message, card))
+
+    def flush_sync(self):
+        """ Save queued messages without event loop (process shutdown) """
+        batch, self.pending = self.pending, []
+        if batch:
+            try:
+                save_batch_sync(batch)
+            except Exception as e:
+                self.on_failure(batch, e)
+
+
+def save_batch_sync(batch):
+    """ Bulk insert batch of ChatMessages and set their ids """
+    with transaction.atomic():
+        ChatMessage.objects.bulk_create(batch)
+        if batch[0].pk is None:
+            # Backend can't return ids from bulk insert (sqlite) but ids are
+            # consecutive since this transaction holds the write lock
+            last_id = (ChatMessage.objects.order_by('-id')
+                       .values_list('id', flat=True).first())
+            for offset, chat_message in enumerate(reversed(batch)):
+                chat_message.pk = last_id - offset
+        # One counter update per room in batch, in same transaction
+        rooms = {}
+        for chat_message in batch:
+            count, _ = rooms.get(chat_message.room_id, (0, None))
+            rooms[chat_message.room_id] = (count + 1, chat_message)
+        for room_id, (count, last_message) in rooms.items():
+            ChatRoom.objects.record_messages(room_id, count, last_message)
+    return batch
+
+
+save_batch = database_sync_to_async(save_batch_sync)
+
+
+@lru_cache(maxsize=None)
+def get_writer():
+    """ Return process-wide MessageWriter or None if write-behind is off """
+    config = getattr(settings, 'CHAT_WRITE_BEHIND', {})
+    if not config.get('ENABLED'):
+        return None
+    return MessageWriter(**config.get('CONFIG', {}))
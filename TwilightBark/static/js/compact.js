@@ -0,0 +1,111 @@
+// Decoder for compact msgpack frames (chat/protocol.py) - room.js asks the
+// server for them and falls back to JSON frames if server can't send them
+
+// Same short codes as FIELD_CODES in chat/protocol.py, mapped back to names
+const FIELD_NAMES = {
+  T: "type", t: "msg_type", m: "message", M: "messages", u: "user",
+  s: "timestamp", p: "pic", i: "id", n: "pageNum", b: "before",
+  h: "hasMore", c: "count", j: "joined", l: "left", J: "joinedCount",
+  L: "leftCount", e: "error", q: "query", g: "page",
+};
+
+function decodeMsgpack(buffer) {
+  // Only the msgpack types the server's encoder produces are handled
+  const view = new DataView(buffer);
+  const bytes = new Uint8Array(buffer);
+  const text = new TextDecoder();
+  let pos = 0;
+
+  function str(length) {
+    const value = text.decode(bytes.subarray(pos, pos + length));
+    pos += length;
+    return value;
+  }
+
+  function array(length) {
+    const value = [];
+    for (let i = 0; i < length; i++)
+      value.push(read());
+    return value;
+  }
+
+  function map(length) {
+    const value = {};
+    for (let i = 0; i < length; i++) {
+      const key = read();
+      value[key] = read();
+    }
+    return value;
+  }
+
+  function bin(length) {
+    const value = buffer.slice(pos, pos + length);
+    pos += length;
+    return value;
+  }
+
+  function read() {
+    const type = bytes[pos++];
+    let value;
+    // Small values keep their length (or value) inside type byte
+    if (type <= 0x7f) return type;
+    if (type <= 0x8f) return map(type & 0x0f);
+    if (type <= 0x9f) return array(type & 0x0f);
+    if (type <= 0xbf) return str(type & 0x1f);
+    if (type >= 0xe0) return type - 0x100;
+    switch (type) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xc4: value = view.getUint8(pos); pos += 1; return bin(value);
+      case 0xc5: value = view.getUint16(pos); pos += 2; return bin(value);
+      case 0xc6: value = view.getUint32(pos); pos += 4; return bin(value);
+      case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+      case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+      case 0xcc: value = view.getUint8(pos); pos += 1; return value;
+      case 0xcd: value = view.getUint16(pos); pos += 2; return value;
+      case 0xce: value = view.getUint32(pos); pos += 4; return value;
+      case 0xcf: value = Number(view.getBigUint64(pos)); pos += 8; return value;
+      case 0xd0: value = view.getInt8(pos); pos += 1; return value;
+      case 0xd1: value = view.getInt16(pos); pos += 2; return value;
+      case 0xd2: value = view.getInt32(pos); pos += 4; return value;
+      case 0xd3: value = Number(view.getBigInt64(pos)); pos += 8; return value;
+      case 0xd9: value = view.getUint8(pos); pos += 1; return str(value);
+      case 0xda: value = view.getUint16(pos); pos += 2; return str(value);
+      case 0xdb: value = view.getUint32(pos); pos += 4; return str(value);
+      case 0xdc: value = view.getUint16(pos); pos += 2; return array(value);
+      case 0xdd: value = view.getUint32(pos); pos += 4; return array(value);
+      case 0xde: value = view.getUint16(pos); pos += 2; return map(value);
+      case 0xdf: value = view.getUint32(pos); pos += 4; return map(value);
+    }
+    throw new Error(`Unsupported msgpack type 0x${type.toString(16)}`);
+  }
+
+  return read();
+}
+
+function expandFields(frame) {
+  // Swap short codes back to full field names
+  const full = {};
+  for (const key in frame)
+    full[FIELD_NAMES[key] || key] = frame[key];
+  return full;
+}
+
+function decodeCompactFrame(buffer) {
+  // Binary frame -> same object the JSON protocol would have sent
+  const frame = decodeMsgpack(buffer);
+  const pics = frame.P || [];
+  delete frame.P;
+  const data = expandFields(frame);
+  if (data.messages) {
+    // Message rows hold index into frame's table of pic urls
+    data.messages = data.messages.map((row) => {
+      const message = expandFields(row);
+      if (typeof message.pic == "number")
+        message.pic = pics[message.pic];
+      return message;
+    });
+  }
+  return data;
+}
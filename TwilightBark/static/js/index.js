@@ -14,4 +14,33 @@ window.addEventListener('load', () => {
     const roomName = document.querySelector('#room-name-input').value;
     window.location.pathname = `/chat/${roomName}/`;
   };
+
+  loadRoomDirectory();
 });
+
+function loadRoomDirectory() {
+  // List busiest rooms under room name input (hidden if there are none)
+  fetch("/chat/")
+    .then((response) => response.json())
+    .then((data) => {
+      const list = document.getElementById("room-list");
+      for (const room of data.rooms) {
+        const item = document.createElement("li");
+        const link = document.createElement("a");
+        link.href = `/chat/${encodeURIComponent(room.name)}/`;
+        link.className = "flex justify-between p-2 hover:text-amber-500 focus:text-amber-500";
+        // textContent so room names can't inject html
+        const name = document.createElement("span");
+        name.textContent = room.name;
+        const stats = document.createElement("span");
+        stats.className = "text-stone-400";
+        stats.textContent = `${room.online} online · ${room.messages} messages`;
+        link.append(name, stats);
+        item.appendChild(link);
+        list.appendChild(item);
+      }
+      if (data.rooms.length)
+        document.getElementById("room-directory").classList.remove("hidden");
+    })
+    .catch(() => {});
+}
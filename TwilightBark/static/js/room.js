@@ -7,21 +7,21 @@ window.addEventListener("load", () => {
   const ws = window.location.protocol == "https:" ? "wss://" : "ws://";
   // Websocket endpoint pattern shown in routing.py - ws/chat/<room_name> - not in URL
   const endpoint = `${ws}${window.location.host}/ws/chat/${roomName}/`;
-  const socket = new WebSocket(endpoint);
+  // Offer compact binary frames first - server picks JSON if it can't send them
+  const socket = new WebSocket(endpoint, ["twilightbark.msgpack", "twilightbark.json"]);
+  socket.binaryType = "arraybuffer";
+  // Id of oldest message shown - sent back to server to load older messages
+  // Only set from history frames - live messages have no id with write-behind
+  let historyCursor = null;
 
   socket.onmessage = (e) => {
     // Parse data coming back from server and direct to correct function
-    const data = JSON.parse(e.data);
+    // Binary frames are compact msgpack (see compact.js), text frames JSON
+    const data = e.data instanceof ArrayBuffer ? decodeCompactFrame(e.data) : JSON.parse(e.data);
     // console.log(data)
-    if (data.msg_type == "join") {
-      // If new user joined, add welcome message to notify other users and update user count
-      if (data.user)
-        addMessage(data.user, "joined");
-      countUsers(data.count)
-    } else if (data.msg_type == "leave") {
-      // If user left, notify other chat members and update user count
-      if (data.user)
-        addMessage(data.user, "left");
+    if (data.msg_type == "presence") {
+      // Batch of users who joined/left recently - notify and update user count
+      handlePresence(data)
       countUsers(data.count)
     } else if (data.msg_type == "message") {
       // If new message, add to chat log DOM
@@ -35,9 +35,24 @@ window.addEventListener("load", () => {
       handleMessagesBacklog(data.messages);
       // Page number will never update automatically but will on first load
       setPageNumber(data.pageNum);
+      setHistoryCursor(data.before, data.hasMore);
+    } else if (data.msg_type == "older_messages") {
+      // Older page of history requested with load older button
+      handleOlderMessages(data.messages);
+      setHistoryCursor(data.before, data.hasMore);
     }
   }
 
+  document.querySelector('#load-older').onclick = (e) => {
+    // Ask server for page of messages sent before oldest message shown
+    if (historyCursor !== null) {
+      socket.send(JSON.stringify({
+        'command': 'load_older',
+        'before': historyCursor
+      }));
+    }
+  };
+
   // Focus on input field when page loads
   document.querySelector('#chat-message-input').focus();
 
@@ -70,11 +85,11 @@ window.addEventListener("load", () => {
     chatLog.appendChild(messageDiv)
   }
 
-  function addToDOM(data, backlog) {
+  function addToDOM(data, backlog, container) {
     // When message comes back from server, add to DOM
     msg = data['message']
     username = `${data.user} `
-    timestamp = data['timestamp']
+    timestamp = formatTimestamp(data['timestamp'])
     pic_url = data.pic
 
     // Create div with message and details about message, and add to chat log
@@ -88,7 +103,10 @@ window.addEventListener("load", () => {
     pic.src = backlog ? defaultPic : pic_url
     pic.classList.add("rounded-full", "border", "border-amber-500", "bg-stone-900", "h-12", "w-12")
     const pic_id = `${data.id}`
-    pic.setAttribute("id", pic_id)
+    // Live messages saved by write-behind have no id yet - only history
+    // rows (always saved) need one to swap in their preloaded pic
+    if (data.id != null)
+      pic.setAttribute("id", pic_id)
     pic.setAttribute("alt", "User profile picture")
     picDiv.appendChild(pic)
     mainDiv.appendChild(picDiv)
@@ -105,12 +123,44 @@ window.addEventListener("load", () => {
     messageDiv.appendChild(msg_tag)
     messageDiv.classList.add("m-3")
     mainDiv.appendChild(messageDiv)
-    chatLog.appendChild(mainDiv)
+    // Older messages are collected in a separate container first
+    const parent = container ? container : chatLog
+    parent.appendChild(mainDiv)
 
     if (backlog)
       preloadImage(pic_url, pic_id)
   }
 
+  function handlePresence(data) {
+    // Names are only sent for small batches, otherwise just how many
+    if (data.joined) {
+      data.joined.forEach((username) => addMessage(username, "joined"));
+      data.left.forEach((username) => addMessage(username, "left"));
+    } else {
+      if (data.joinedCount)
+        addMessage(`${data.joinedCount} users`, "joined")
+      if (data.leftCount)
+        addMessage(`${data.leftCount} users`, "left")
+    }
+  }
+
+  function formatTimestamp(timestamp) {
+    // Server sends epoch milliseconds when CHAT_TIMESTAMP_FORMAT is 'epoch'
+    if (typeof timestamp != "number")
+      return timestamp
+    const date = new Date(timestamp)
+    const time = date.toLocaleTimeString("en-US", { hour: "numeric", minute: "2-digit" })
+    const today = new Date()
+    const yesterday = new Date()
+    yesterday.setDate(today.getDate() - 1)
+    if (date.toDateString() == today.toDateString())
+      return `today at ${time}`
+    if (date.toDateString() == yesterday.toDateString())
+      return `yesterday at ${time}`
+    const day = date.toLocaleDateString("en-US", { month: "2-digit", day: "2-digit", year: "numeric" })
+    return `${day} at ${time}`
+  }
+
   function countUsers(count) {
     // When user count comes back from server, update user count
     element = document.getElementById("user_count")
@@ -126,6 +176,22 @@ window.addEventListener("load", () => {
     }
   }
 
+  function handleOlderMessages(messages) {
+    // Messages come oldest first, so insert them as one block above log
+    const block = document.createDocumentFragment()
+    messages.forEach((message) => {
+      addToDOM(message, 1, block)
+    });
+    const chatLog = document.getElementById("chat_log")
+    chatLog.insertBefore(block, chatLog.firstChild)
+  }
+
+  function setHistoryCursor(before, hasMore) {
+    // Remember where history left off and hide button when nothing is left
+    historyCursor = hasMore ? before : null
+    document.getElementById("load-older").hidden = !hasMore
+  }
+
   function setPageNumber(pageNumber) {
     // Add page number to DOM on first load
     document.getElementById("page_number").innerHTML = `Page ${pageNumber}`
@@ -1,10 +1,10 @@
 """ Customization of default user auth so user login is case-insensitive """
 from django.contrib.auth import get_user_model
-from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.backends import AllowAllUsersModelBackend
 
 
-class CaseInsensitiveModelBackend(ModelBackend):
-    """ Custom ModelBackend that allows case-insensitive user auth"""
+class CaseInsensitiveModelBackend(AllowAllUsersModelBackend):
+    """ Only auth backend - one indexed lookup on lower-cased email """
 
     def authenticate(self, request, username=None, password=None, **kwargs):
         """ Override default method that returns user based on credentials """
@@ -14,15 +14,15 @@ class CaseInsensitiveModelBackend(ModelBackend):
         if username is None:
             # Gets username based on email address
             username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
 
         try:
-            # If username is not None, try to get user object
-            # Get user object based on username
-            case_insensitive_username = f'{UserModel.USERNAME_FIELD}__iexact'
-            user = (UserModel._default_manager
-                    .get(**{case_insensitive_username: username}))
+            # Exact match on email_lower uses its unique index (iexact can't)
+            user = UserModel._default_manager.get(
+                email_lower=username.lower())
         except UserModel.DoesNotExist:
-            # If can't find user, set password to password passed in
+            # Hash anyway so unknown emails take as long as wrong passwords
             UserModel().set_password(password)
 
         else:
@@ -0,0 +1,73 @@
+""" Cached user data - chat cards and users behind websocket sessions """
+from django.conf import settings
+from django.core.cache import cache
+
+
+def card_key(user_id):
+    """ Cache key for one user's card """
+    return f'user:card:{user_id}'
+
+
+def make_card(user):
+    """ Parts of user shown next to every chat message """
+    return {'user': user.username, 'pic': user.get_avatar_url()}
+
+
+def card_timeout():
+    """ Seconds a card stays cached (cards are also dropped on edit) """
+    return getattr(settings, 'USER_CARD_TIMEOUT', 3600)
+
+
+def cached_user_card(user_id):
+    """ Card if cached, else None (never queries db) """
+    return cache.get(card_key(user_id))
+
+
+def get_user_card(user_id):
+    """ Card for one user - read by id from db on a miss """
+    # Not built from caller's user object - a socket's scope user can be
+    # older than the edit that dropped the card
+    return get_user_cards([user_id])[user_id]
+
+
+def get_user_cards(user_ids):
+    """ Return {user id: card} - users not cached are read in one query """
+    from .models import User
+    keys = {card_key(user_id): user_id for user_id in set(user_ids)}
+    cards = {keys[key]: card for key, card in cache.get_many(keys).items()}
+    missing = [user_id for user_id in keys.values() if user_id not in cards]
+    if missing:
+        users = (User.objects.filter(id__in=missing)
+                 .only('id', 'username', 'profile_pic', 'profile_pic_webp'))
+        found = {user.id: make_card(user) for user in users}
+        cache.set_many({card_key(user_id): card
+                        for user_id, card in found.items()}, card_timeout())
+        cards.update(found)
+    return cards
+
+
+def invalidate_user_card(user_id):
+    """ Drop cached card after username or profile pic changes """
+    cache.delete(card_key(user_id))
+
+
+def user_key(user_id):
+    """ Cache key for whole user object (websocket handshakes) """
+    return f'user:object:{user_id}'
+
+
+def get_cached_user(user_id, load):
+    """ Return cached user, calling load(user_id) on a miss (may be None) """
+    key = user_key(user_id)
+    user = cache.get(key)
+    if user is None:
+        user = load(user_id)
+        if user is not None:
+            cache.set(key, user,
+                      getattr(settings, 'USER_CACHE_TIMEOUT', 300))
+    return user
+
+
+def invalidate_cached_user(user_id):
+    """ Drop cached user after any change (password, email, logout...) """
+    cache.delete(user_key(user_id))
@@ -22,7 +22,7 @@ class RegistrationForm(UserCreationForm):
         email = self.cleaned_data['email'].lower()
         try:
             # Try to get user with that email - if can, raise error
-            user = User.objects.get(email=email)
+            user = User.objects.get(email_lower=email)
         except User.DoesNotExist:
             # If no user with that email found, return email
             return email
@@ -51,16 +51,24 @@ class UserAuthenticationForm(forms.ModelForm):
         model = User
         fields = ('email', 'password')
 
+    # User found by clean() - view logs them in without authenticating again
+    user_cache = None
+
     def clean(self):
         """ Validate email and password (defined in settings.py) """
         if self.is_valid():
             # Get cleaned data from form
             email = self.cleaned_data['email']
             pw = self.cleaned_data['password']
-            # No need to return - just raise error if can't authenticate
-            if not authenticate(email=email, password=pw):
+            # Raise error if can't authenticate - one lookup, one hash
+            self.user_cache = authenticate(email=email, password=pw)
+            if not self.user_cache:
                 raise forms.ValidationError('Invalid email or password')
 
+    def get_user(self):
+        """ Return user authenticated while validating form """
+        return self.user_cache
+
 
 class AccountUpdateForm(forms.ModelForm):
     """ Define form for updating user account """
@@ -76,7 +84,8 @@ class AccountUpdateForm(forms.ModelForm):
         try:
             # Try to get user with that email - if can, raise error
             # exclude current user so won't get error if stays the same
-            user = User.objects.exclude(id=self.instance.id).get(email=email)
+            user = (User.objects.exclude(id=self.instance.id)
+                    .get(email_lower=email))
         except User.DoesNotExist:
             # If no user with that email found, return email
             return email
@@ -108,5 +117,6 @@ class AccountUpdateForm(forms.ModelForm):
         # commit=True is default, so will be committing to db
         if commit:
             # Now that changes are committed, save to db
+            # (save also drops cached copies of user used by chat)
             user.save()
         return user
@@ -0,0 +1,93 @@
+""" Background pipeline that makes small copies of profile pics for chat """
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from functools import lru_cache
+from PIL import Image, ImageOps
+from .cards import invalidate_user_card
+
+
+logger = logging.getLogger(__name__)
+
+# Square copies made for every uploaded pic - fields on User hold their
+# file names. room.js shows avatars at 48px, so 96px stays sharp on high
+# density screens (only copy chat sends - add a size here once it's served)
+AVATAR_SIZES = {
+    'profile_pic_webp': (96, 'WEBP'),
+}
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    """ Pillow thread pool (started by first upload, not on import) """
+    # Pillow work runs here so saving a form never waits for resizing
+    return ThreadPoolExecutor(
+        max_workers=getattr(settings, 'AVATAR_WORKERS', 2),
+        thread_name_prefix='avatars')
+
+
+def schedule_avatar_resize(user_id):
+    """ Resize user's pic in background once current transaction commits """
+    transaction.on_commit(lambda: get_executor().submit(resize_in_background,
+                                                        user_id))
+
+
+def resize_in_background(user_id):
+    """ Thread pool job - own db connection, errors logged not raised """
+    from .models import User
+    close_old_connections()
+    try:
+        user = User.objects.get(pk=user_id)
+        generate_avatars(user)
+    except Exception:
+        logger.exception('Could not resize profile pic for user %s', user_id)
+    finally:
+        close_old_connections()
+
+
+def generate_avatars(user):
+    """ Save resized copies of user's profile pic and store their names """
+    from .models import User
+    source = user.profile_pic.name
+    if not source or source == User.DEFAULT_PROFILE_PIC:
+        # Default pic is shared by everyone - served as is
+        return False
+    storage = user.profile_pic.storage
+    with storage.open(source, 'rb') as f:
+        img = Image.open(f)
+        # Respect phone camera rotation, then work in RGBA for transparency
+        img = ImageOps.exif_transpose(img).convert('RGBA')
+
+    # Name copies after source so a new upload gets new urls (no stale cache)
+    digest = hashlib.sha1(source.encode()).hexdigest()[:8]
+    names = {}
+    for field, (size, image_format) in AVATAR_SIZES.items():
+        thumb = ImageOps.fit(img, (size, size), Image.LANCZOS)
+        buffer = BytesIO()
+        thumb.save(buffer, image_format)
+        extension = image_format.lower()
+        name = f'profile_images/avatars/{user.id}_{digest}_{size}.{extension}'
+        # Same name means same source pic - replace rather than add suffix
+        storage.delete(name)
+        names[field] = storage.save(name, ContentFile(buffer.getvalue()))
+
+    # Only store if pic wasn't changed again while resizing
+    updated = (User.objects.filter(pk=user.pk, profile_pic=source)
+               .update(**names))
+    if updated:
+        # Chat can switch to small copy now
+        invalidate_user_card(user.id)
+        # Remove copies made earlier for same user (re-run by backfill)
+        stale = [getattr(user, field).name for field in AVATAR_SIZES]
+        stale = [name for name in stale
+                 if name and name not in names.values()]
+    else:
+        # Pic changed again while resizing - these copies are already stale
+        stale = names.values()
+    for name in stale:
+        storage.delete(name)
+    return bool(updated)
@@ -0,0 +1,48 @@
+""" Make chat avatars for old pics - python3 manage.py backfill_avatars """
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from user.images import generate_avatars
+from user.models import User
+
+
+class Command(BaseCommand):
+    """ Resize every uploaded profile pic that has no small copies yet """
+    help = 'Generate resized chat avatars for existing profile pics'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Redo users that already have avatars')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Pictures resized at the same time')
+
+    def handle(self, *args, **options):
+        """ Resize in thread pool, printing progress as users finish """
+        users = User.objects.exclude(profile_pic=User.DEFAULT_PROFILE_PIC)
+        if not options['all']:
+            users = users.filter(profile_pic_webp='')
+        ids = list(users.values_list('id', flat=True))
+        self.stdout.write(f'Resizing profile pics for {len(ids)} users')
+
+        done = failed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            for user_id, error in pool.map(resize_user, ids):
+                if error:
+                    failed += 1
+                    self.stderr.write(f'User {user_id}: {error}')
+                else:
+                    done += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Resized {done} profile pics ({failed} failed)'))
+
+
+def resize_user(user_id):
+    """ Resize one user's pic - returns (user id, error or None) """
+    close_old_connections()
+    try:
+        generate_avatars(User.objects.get(pk=user_id))
+        return user_id, None
+    except Exception as e:
+        return user_id, e
+    finally:
+        close_old_connections()
@@ -0,0 +1,56 @@
+""" Measure login throughput - python3 manage.py bench_login """
+import time
+from django.contrib.auth import authenticate
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from user.models import User
+
+
+# (case name, email typed, password typed) - all against one bench user
+CASES = (
+    ('valid', 'bench@bench.test', 'bench-password'),
+    ('valid_mixed_case', 'Bench@Bench.TEST', 'bench-password'),
+    ('wrong_password', 'bench@bench.test', 'not-the-password'),
+    ('unknown_user', 'nobody@bench.test', 'bench-password'),
+)
+
+
+class Command(BaseCommand):
+    """ Time authenticate() for good and bad logins on a test database """
+    help = ('Benchmark login throughput for valid, wrong password and '
+            'unknown user logins, on a throwaway test database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20,
+                            help='Logins timed per case (each one hashes)')
+
+    def handle(self, *args, **options):
+        """ Run every case on test db and print report """
+        # Never touch real data - build and drop a test database
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True,
+                                                      serialize=False)
+        try:
+            User.objects.create_user(email='bench@bench.test',
+                                     username='bench',
+                                     password='bench-password')
+            for name, email, password in CASES:
+                self.run_case(name, email, password, options['iterations'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run_case(self, name, email, password, iterations):
+        """ Time iterations logins and count their db queries """
+        expected = password == 'bench-password' and 'nobody' not in email
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                user = authenticate(email=email, password=password)
+                if bool(user) != expected:
+                    raise CommandError(f'{name}: unexpected login result')
+            elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'{name:<20} {iterations / elapsed:8.1f} logins/sec '
+            f'{elapsed / iterations * 1000:8.2f} ms/login '
+            f'{len(queries) / iterations:5.2f} queries/login')
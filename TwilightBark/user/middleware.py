@@ -0,0 +1,48 @@
+""" Websocket auth that reads sessions and users from cache, not the db """
+from channels.auth import AuthMiddleware
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import (BACKEND_SESSION_KEY, HASH_SESSION_KEY,
+                                 SESSION_KEY, get_user_model, load_backend)
+from django.contrib.auth.models import AnonymousUser
+from django.utils.crypto import constant_time_compare
+from chat.db import database_sync_to_async
+from .cards import get_cached_user
+
+
+@database_sync_to_async
+def get_user(scope):
+    """ Same checks as channels.auth.get_user, with user loaded from cache """
+    session = scope["session"]
+    user = None
+    try:
+        # Session itself comes from cache too (cached_db session engine)
+        user_id = get_user_model()._meta.pk.to_python(session[SESSION_KEY])
+        backend_path = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        pass
+    else:
+        if backend_path in settings.AUTHENTICATION_BACKENDS:
+            backend = load_backend(backend_path)
+            user = get_cached_user(user_id, backend.get_user)
+            # Verify session - password change since login logs user out
+            if hasattr(user, "get_session_auth_hash"):
+                session_hash = session.get(HASH_SESSION_KEY)
+                if not (session_hash and constant_time_compare(
+                        session_hash, user.get_session_auth_hash())):
+                    session.flush()
+                    user = None
+    return user or AnonymousUser()
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """ AuthMiddleware that resolves scope["user"] from cache """
+
+    async def resolve_scope(self, scope):
+        """ Fill in lazy scope["user"] - cache hit means no db query """
+        scope["user"]._wrapped = await get_user(scope)
+
+
+def CachedAuthMiddlewareStack(inner):
+    """ Drop-in for channels' AuthMiddlewareStack using cached users """
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.12 on 2026-10-18 10:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0002_auto_20220228_0339'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='profile_pic_webp',
+            field=models.ImageField(blank=True, editable=False, max_length=200, upload_to=''),
+        ),
+    ]
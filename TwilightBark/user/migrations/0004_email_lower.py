@@ -0,0 +1,45 @@
+# Generated by Django 2.2.12 on 2026-10-18 10:24
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+def fill_email_lower(apps, schema_editor):
+    """ Copy lower-cased email for existing users (one UPDATE) """
+    User = apps.get_model('user', 'User')
+    users = User.objects.annotate(lower=Lower('email'))
+    # Emails only differing by case would break unique index mid-UPDATE
+    clashes = (users.values('lower').annotate(count=Count('id'))
+               .filter(count__gt=1).values_list('lower', flat=True))
+    if clashes:
+        rows = (users.filter(lower__in=list(clashes)).order_by('lower', 'id')
+                .values_list('id', 'email'))
+        raise ValueError(
+            'These users have emails that only differ by case, so they '
+            'would log in as the same account. Change or delete all but '
+            'one of each before migrating:\n' +
+            '\n'.join(f'  user {id}: {email}' for id, email in rows))
+    users.update(email_lower=Lower('email'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0003_profile_pic_thumbnails'),
+    ]
+
+    operations = [
+        # Nullable first so existing rows don't all collide on ''
+        migrations.AddField(
+            model_name='user',
+            name='email_lower',
+            field=models.EmailField(editable=False, max_length=60, null=True, unique=True),
+        ),
+        migrations.RunPython(fill_email_lower, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='user',
+            name='email_lower',
+            field=models.EmailField(editable=False, max_length=60, unique=True),
+        ),
+    ]
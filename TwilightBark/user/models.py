@@ -1,7 +1,11 @@
 """ Define User models for basic user and admin user """
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
-# from PIL import Image
+from django.contrib.auth.signals import user_logged_out
+from .cards import invalidate_cached_user, invalidate_user_card
+from .images import AVATAR_SIZES, schedule_avatar_resize
 
 
 class AccountManager(BaseUserManager):
@@ -53,12 +57,19 @@ class User(AbstractBaseUser):
 
     email = models.EmailField(verbose_name="email", max_length=60,
                               unique=True)
+    # Lower-cased copy of email so logins are one exact lookup on its index
+    email_lower = models.EmailField(max_length=60, unique=True,
+                                    editable=False)
     username = models.CharField(max_length=30, unique=True)
     date_joined = models.DateTimeField(verbose_name='date joined',
                                        auto_now_add=True)
     profile_pic = models.ImageField(max_length=200,
                                     upload_to='profile_images',
                                     default='default_pic.png')
+    # Small copy of profile_pic made in background (see user/images.py)
+    # Blank until resized - chat falls back to full profile_pic
+    profile_pic_webp = models.ImageField(max_length=200, blank=True,
+                                         editable=False)
     hide_email = models.BooleanField(default=True)
     is_admin = models.BooleanField(default=False)
     is_superuser = models.BooleanField(default=False)
@@ -73,10 +84,49 @@ class User(AbstractBaseUser):
     # Link to custom user manager above
     objects = AccountManager()
 
+    # Shared pic for users who haven't uploaded their own
+    DEFAULT_PROFILE_PIC = 'default_pic.png'
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """ Remember stored pic so save() can tell when a new one is set """
+        user = super().from_db(db, field_names, values)
+        user._saved_profile_pic = user.profile_pic.name
+        return user
+
     def get_profile_pic_filename(self):
         """ Return user-defined profile pic name that is default overridden """
         return (str(self.profile_pic))
 
+    def get_avatar_url(self):
+        """ Small profile pic for chat - full pic until resize finishes """
+        if self.profile_pic_webp:
+            return self.profile_pic_webp.url
+        return self.profile_pic.url
+
+    def save(self, *args, **kwargs):
+        """ Override save method to resize new profile pic in background """
+        # Kept in step with email here so every save path updates it
+        self.email_lower = self.email.lower()
+        new_pic = (self.profile_pic.name !=
+                   getattr(self, '_saved_profile_pic', None))
+        if new_pic:
+            # Copies of old pic no longer match - delete after commit
+            stale = [getattr(self, field).name for field in AVATAR_SIZES]
+            storage = self.profile_pic.storage
+            for field in AVATAR_SIZES:
+                setattr(self, field, '')
+        super().save(*args, **kwargs)
+        # Chat cards and websocket handshakes use cached copies - reload
+        user_id = self.pk
+        transaction.on_commit(lambda: forget_user(user_id))
+        if new_pic:
+            self._saved_profile_pic = self.profile_pic.name
+            for name in filter(None, stale):
+                transaction.on_commit(lambda name=name: storage.delete(name))
+            if self.profile_pic.name != self.DEFAULT_PROFILE_PIC:
+                schedule_avatar_resize(self.pk)
+
     # These are more default methods that need to be overridden
     def __str__(self):
         """ When type {user}, prints username rather than address """
@@ -90,15 +140,21 @@ class User(AbstractBaseUser):
         """ Checks if user has permission to view app at all """
         return True
 
-    # # Raises error but this is how you might resize profile pic (Pillow)
-    # def save(self):
-    #     """ Override save method to resize profile pic """
-    #     super().save()
-    #     # Get existing image
-    #     img = Image.open(self.profile_pic.path)
-    #     # If larger than 300px x 300px, resize
-    #     if img.height > 300 or img.width > 300:
-    #         new_size = (300, 300)
-    #         img.thumbnail(new_size)
-    #         # Save resized image
-    #         img.save(self.profile_pic.path)
+
+def forget_user(user_id):
+    """ Drop every cached copy of user """
+    invalidate_cached_user(user_id)
+    invalidate_user_card(user_id)
+
+
+@receiver(post_delete, sender=User)
+def forget_deleted_user(sender, instance, **kwargs):
+    """ Deleted user's open sessions must stop resolving to them """
+    forget_user(instance.pk)
+
+
+@receiver(user_logged_out)
+def forget_logged_out_user(sender, request, user, **kwargs):
+    """ Logging out drops cached user along with session """
+    if user is not None:
+        invalidate_cached_user(user.pk)
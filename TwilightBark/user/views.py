@@ -1,6 +1,6 @@
 """ Defines what each page looks like - matches url to html file """
 from django.conf import settings
-from django.contrib.auth import authenticate, login, logout
+from django.contrib.auth import login, logout
 from django.http import HttpResponse
 from django.shortcuts import render, redirect
 from .forms import RegistrationForm, UserAuthenticationForm, AccountUpdateForm
@@ -20,12 +20,8 @@ def register_user(request, *args, **kwargs):
         form = RegistrationForm(request.POST)
         if form.is_valid():
             # is_valid() does type checking, etc on fields in form
-            form.save()
-            # Gets email and password from form
-            email = form.cleaned_data.get('email').lower()
-            pw = form.cleaned_data.get('password1')
-            # Gets user based on email and password
-            user = authenticate(email=email, password=pw)
+            # New user already has their password - no need to authenticate
+            user = form.save()
             # Logs user in
             login(request, user)
             # Redirects to correct page (whether 'next' or index)
@@ -58,11 +54,8 @@ def login_user(request, *args, **kwargs):
         # Create new form instance and populate with data from request
         form = UserAuthenticationForm(request.POST)
         if form.is_valid():
-            # is_valid() 'cleans' aka type checks and validates input
-            email = request.POST['email'].lower()
-            pw = request.POST['password']
-            # Gets user based on email and password
-            user = authenticate(email=email, password=pw)
+            # is_valid() 'cleans' aka type checks and authenticates input
+            user = form.get_user()
             if user:
                 # Logs user in and redirects to correct page
                 login(request, user)